@@ -1,6 +1,6 @@
 """
-WSGI entry point for production deployment.
-This file is used by gunicorn and other WSGI servers.
+ASGI entry point for production deployment.
+This file is used by uvicorn and other ASGI servers.
 """
 
 from main import app
@@ -0,0 +1,34 @@
+"""
+Gunicorn configuration for production deployment.
+
+Run with: gunicorn -c gunicorn_conf.py app:app
+
+Each worker is a Uvicorn event loop, so requests waiting on OpenAI don't
+occupy a thread apiece. Without REDIS_URL each worker keeps its own
+in-memory conversations, so only one worker runs; set REDIS_URL to scale
+out to WEB_CONCURRENCY (default 2 x CPUs + 1) workers.
+"""
+
+import os
+import sys
+
+bind = f"{os.environ.get('HOST', '0.0.0.0')}:{os.environ.get('PORT', '10000')}"
+
+if os.environ.get('REDIS_URL'):
+    workers = int(os.environ.get('WEB_CONCURRENCY', (os.cpu_count() or 2) * 2 + 1))
+else:
+    # Conversations would land in whichever worker served the request and
+    # be missing from the others
+    workers = 1
+    if int(os.environ.get('WEB_CONCURRENCY', 1)) > 1:
+        print("REDIS_URL is not set; ignoring WEB_CONCURRENCY and running a single worker", file=sys.stderr)
+
+worker_class = 'uvicorn_worker.UvicornWorker'
+
+# Each worker starts its own image process pool; share the CPUs between
+# them (workers inherit the environment from the master)
+os.environ.setdefault('IMAGE_POOL_WORKERS', str(max(1, (os.cpu_count() or 1) // workers)))
+
+keepalive = 30
+timeout = 120  # vision calls can take a while
+graceful_timeout = 30
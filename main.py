@@ -1,42 +1,79 @@
-from flask import Flask, jsonify
+import os
+from dotenv import load_dotenv
+
+# Load .env once, before the services are imported (they read their
+# settings at import time). Variables already set in the environment win
+load_dotenv()
+
+import logging
+import orjson
+from quart import Quart, Response
+from quart.json.provider import JSONProvider
 from routes.diagnose.route import diagnose_bp
 from routes.chat.route import chat_bp
 from routes.messages.route import messages_bp
+from services.openai_client import close_client, load_token_encoders
+from services.redis_client import close_redis
+
+class ORJSONProvider(JSONProvider):
+    """JSON provider backed by orjson, used by jsonify and request.get_json."""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper())
 
-app = Flask(__name__)
+app = Quart(__name__)
+app.json = ORJSONProvider(app)
 
 # Production configuration
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
 # Enable CORS for all routes
-from flask_cors import CORS
-CORS(app)
+from quart_cors import cors
+app = cors(app)
+
+# The home body never changes, so serialize it once; load balancers poll
+# this endpoint as a health check
+_HOME_BODY = orjson.dumps({
+    'message': 'Plant Care API',
+    'endpoints': {
+        'diagnosis': '/plant/diagnose (POST) - Upload plant image for diagnosis',
+        'chat': '/chat (POST) - Ask questions about plant care',
+        'messages': '/messages (POST) - Chat with AI assistant with conversation management',
+        'conversation': '/messages/conversation (GET) - Get conversation history',
+        'conversations': '/messages/conversations (GET) - Get user conversations',
+        'delete_conversation': '/messages/conversation (DELETE) - Delete conversation',
+        'clear_all': '/messages/clear (DELETE) - Clear all conversations'
+    },
+    'status': 'active'
+})
 
 @app.route('/')
-def home():
-    return jsonify({
-        'message': 'Plant Care API',
-        'endpoints': {
-            'diagnosis': '/plant/diagnose (POST) - Upload plant image for diagnosis',
-            'chat': '/chat (POST) - Ask questions about plant care',
-            'messages': '/messages (POST) - Chat with AI assistant with conversation management',
-            'conversation': '/messages/conversation (GET) - Get conversation history',
-            'conversations': '/messages/conversations (GET) - Get user conversations',
-            'delete_conversation': '/messages/conversation (DELETE) - Delete conversation',
-            'clear_all': '/messages/clear (DELETE) - Clear all conversations'
-        },
-        'status': 'active'
-    })
+async def home():
+    return Response(_HOME_BODY, mimetype='application/json')
 
 # Register blueprints
 app.register_blueprint(diagnose_bp, url_prefix='/plant')
 app.register_blueprint(chat_bp, url_prefix='')
 app.register_blueprint(messages_bp, url_prefix='')
 
+@app.before_serving
+async def startup():
+    """Load tokenizers before taking requests, so no request blocks on the download."""
+    await load_token_encoders()
+
+@app.after_serving
+async def shutdown():
+    """Release shared connection pools when the server stops."""
+    await close_client()
+    await close_redis()
+
 
 if __name__ == '__main__':
-    import os
-    
     # Production configuration
     PORT = int(os.environ.get('PORT', 5000))
     HOST = os.environ.get('HOST', '0.0.0.0')
@@ -50,26 +87,27 @@ if __name__ == '__main__':
         print(f"📍 Port: {PORT}")
         print("-" * 50)
         
-        # Production server configuration
-        app.run(
-            host=HOST,
-            port=PORT,
-            debug=False,
-            threaded=True  # Enable threading for better performance
-        )
+        # Production server: hand over to gunicorn with Uvicorn workers
+        # (see gunicorn_conf.py for worker and timeout settings)
+        os.environ['HOST'] = HOST
+        os.environ['PORT'] = str(PORT)
+        os.execvp('gunicorn', ['gunicorn', '-c', 'gunicorn_conf.py', 'app:app'])
     else:
         # Development configuration
         import socket
+        import uvicorn
         
         def get_local_ip():
             """Get the local IP address of this machine."""
             try:
-                # Connect to a remote server to determine local IP
+                # Connect to a remote server to determine local IP; the
+                # timeout keeps boot from hanging on an isolated network
                 with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+                    s.settimeout(0.5)
                     s.connect(("8.8.8.8", 80))
                     local_ip = s.getsockname()[0]
                 return local_ip
-            except Exception:
+            except OSError:
                 return "127.0.0.1"  # Fallback to localhost
         
         # Get local IP for development
@@ -83,8 +121,9 @@ if __name__ == '__main__':
         print("-" * 50)
         
         # Run the server
-        app.run(
+        uvicorn.run(
+            "main:app",
             host=HOST,  # Listen on all network interfaces
             port=PORT,
-            debug=DEBUG
+            reload=DEBUG
         )
@@ -1,10 +1,29 @@
-from flask import request, jsonify
-from services.openai_client import OpenAIClient
+import logging
+from quart import request, jsonify
+from routes.errors import prebuilt_error, error_response
+from routes.streaming import wants_stream, sse_event, sse_response
+from services.openai_client import get_client
 
-# Initialize OpenAI client
-openai_client = OpenAIClient()
+logger = logging.getLogger(__name__)
 
-def chat_with_ai():
+# Shared OpenAI client (one connection pool for the whole app)
+openai_client = get_client()
+
+# Static error responses, serialized once
+_ERR_NO_JSON = prebuilt_error('No JSON data provided. Please send a message in JSON format.', 400)
+_ERR_NO_MESSAGE = prebuilt_error('No message provided. Please include a message in your request.', 400)
+_ERR_BAD_HISTORY = prebuilt_error('Conversation history must be a list of message objects.', 400)
+
+def _is_chat_message(entry) -> bool:
+    """Check that a history entry is a message the chat API accepts: a string role plus content."""
+    return (
+        isinstance(entry, dict)
+        and isinstance(entry.get('role'), str)
+        # Text, a list of content parts, or null (e.g. assistant tool calls)
+        and isinstance(entry.get('content'), (str, list, type(None)))
+    )
+
+async def chat_with_ai():
     """
     Handle chat requests with users about plant care.
     
@@ -12,40 +31,39 @@ def chat_with_ai():
     - POST with JSON data
     - 'message' field containing the user's question
     - Optional 'conversation_history' field with previous messages
+    - Optional 'stream' field (or an 'Accept: text/event-stream' header) to
+      receive the response as Server-Sent Events while it is generated
     """
     try:
         # Get JSON data from request
-        data = request.get_json()
-
-        print(data)
+        data = await request.get_json()
+        
+        logger.debug("Chat request: %s", data)
         
         if not data:
-            return jsonify({
-                'success': False,
-                'error': 'No JSON data provided. Please send a message in JSON format.'
-            }), 400
+            return error_response(_ERR_NO_JSON)
         
         # Extract user message
         user_message = data.get('message', '').strip()
         
         if not user_message:
-            return jsonify({
-                'success': False,
-                'error': 'No message provided. Please include a message in your request.'
-            }), 400
+            return error_response(_ERR_NO_MESSAGE)
         
         # Get conversation history if provided
         conversation_history = data.get('conversation_history', [])
         
         # Validate conversation history format
-        if conversation_history and not isinstance(conversation_history, list):
-            return jsonify({
-                'success': False,
-                'error': 'Conversation history must be a list of message objects.'
-            }), 400
+        if conversation_history and not (
+            isinstance(conversation_history, list) and all(map(_is_chat_message, conversation_history))
+        ):
+            return error_response(_ERR_BAD_HISTORY)
+        
+        # Stream tokens as they arrive when the client asks for SSE
+        if wants_stream(data.get('stream')):
+            return sse_response(_chat_events(user_message, conversation_history))
         
         # Chat with AI
-        chat_result = openai_client.chat_with_ai(user_message, conversation_history)
+        chat_result = await openai_client.chat_with_ai(user_message, conversation_history)
         
         if chat_result.get('success'):
             return jsonify({
@@ -67,3 +85,14 @@ def chat_with_ai():
             'success': False,
             'error': f'Server error during chat: {str(e)}'
         }), 500
+
+async def _chat_events(user_message, conversation_history):
+    """Relay streamed chat events as SSE frames: deltas, then a final 'done' event."""
+    # The 200 header is already sent, so any error has to end the stream
+    # with a 'done' frame rather than escape the generator
+    try:
+        async for event in openai_client.chat_with_ai_stream(user_message, conversation_history):
+            yield sse_event(event)
+    except Exception as e:
+        logger.exception("Chat stream failed")
+        yield sse_event({'done': True, 'success': False, 'error': f'Server error during chat: {str(e)}'})
@@ -1,21 +1,47 @@
 import os
-import tempfile
-from flask import request, jsonify
-from werkzeug.utils import secure_filename
-from services.openai_client import OpenAIClient
+import asyncio
+import logging
+import mimetypes
+from quart import request, jsonify
+from routes.errors import prebuilt_error, error_response
+from routes.streaming import wants_stream, sse_event, sse_response
+from werkzeug.exceptions import RequestEntityTooLarge
+from streaming_form_data import StreamingFormDataParser
+from streaming_form_data.targets import ValueTarget
+from streaming_form_data.validators import MaxSizeValidator, ValidationError
+from services.openai_client import get_client
 
-# Initialize OpenAI client
-openai_client = OpenAIClient()
+logger = logging.getLogger(__name__)
+
+# Shared OpenAI client (one connection pool for the whole app)
+openai_client = get_client()
 
 # Allowed file extensions for images
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp'}
+ALLOWED_EXTENSIONS = frozenset({'.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp'})
+
+# Upload size limits, enforced while the multipart body is streamed in
+MAX_IMAGE_SIZE = 16 * 1024 * 1024  # 16MB
+MAX_FIELD_SIZE = 64 * 1024  # additional_info / label text
+
+# Vision calls handled at once per worker; each runs for several seconds
+# and keeps its image in memory, so later requests wait their turn. Uploads
+# are parsed before a slot is taken.
+DIAGNOSE_CONCURRENCY = int(os.environ.get('DIAGNOSE_CONCURRENCY', 8))
+diagnose_slots = asyncio.Semaphore(DIAGNOSE_CONCURRENCY)
 
-def allowed_file(filename):
+# Static error responses, serialized once
+_ERR_NO_IMAGE = prebuilt_error('No image file provided. Please upload an image of your plant.', 400)
+_ERR_NO_IMAGE_SELECTED = prebuilt_error('No image file selected. Please choose an image to upload.', 400)
+_ERR_INVALID_TYPE = prebuilt_error(
+    f'Invalid file type. Allowed types: {", ".join(sorted(ext[1:] for ext in ALLOWED_EXTENSIONS))}', 400
+)
+_ERR_TOO_LARGE = prebuilt_error(f'Upload too large. Images must be under {MAX_IMAGE_SIZE // (1024 * 1024)}MB.', 413)
+
+def allowed_file(filename: str) -> bool:
     """Check if the uploaded file has an allowed extension."""
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    return os.path.splitext(filename)[1].lower() in ALLOWED_EXTENSIONS
 
-def diagnose_plant():
+async def diagnose_plant():
     """
     Handle plant diagnosis requests with image upload.
     
@@ -24,74 +50,113 @@ def diagnose_plant():
     - 'image' field containing the plant image file
     - Optional 'additional_info' field with text context
     - Optional 'label' field with user-provided plant/crop name
+    - Optional 'stream' field ('true') or an 'Accept: text/event-stream'
+      header to receive diagnosis fields as Server-Sent Events as soon as
+      the model writes them
+    
+    The multipart body is parsed as it arrives and the image bytes are
+    handed straight to the OpenAI client, without a temporary file.
     """
     try:
-        # Check if image file is present
-        if 'image' not in request.files:
-            return jsonify({
-                'success': False,
-                'error': 'No image file provided. Please upload an image of your plant.'
-            }), 400
+        # Only multipart uploads can carry an image
+        if request.mimetype != 'multipart/form-data':
+            return error_response(_ERR_NO_IMAGE)
         
-        image_file = request.files['image']
+        image_target = ValueTarget(validator=MaxSizeValidator(MAX_IMAGE_SIZE))
+        info_target = ValueTarget(validator=MaxSizeValidator(MAX_FIELD_SIZE))
+        label_target = ValueTarget(validator=MaxSizeValidator(MAX_FIELD_SIZE))
+        stream_target = ValueTarget(validator=MaxSizeValidator(MAX_FIELD_SIZE))
+        
+        parser = StreamingFormDataParser(headers=request.headers)
+        parser.register('image', image_target)
+        parser.register('additional_info', info_target)
+        parser.register('label', label_target)
+        parser.register('stream', stream_target)
+        
+        # Stream the upload chunk by chunk
+        try:
+            async for chunk in request.body:
+                parser.data_received(chunk)
+        except (ValidationError, RequestEntityTooLarge):
+            return error_response(_ERR_TOO_LARGE)
+        
+        # Check if image file is present
+        if image_target.multipart_filename is None:
+            return error_response(_ERR_NO_IMAGE)
         
         # Check if file is selected
-        if image_file.filename == '':
-            return jsonify({
-                'success': False,
-                'error': 'No image file selected. Please choose an image to upload.'
-            }), 400
+        if image_target.multipart_filename == '':
+            return error_response(_ERR_NO_IMAGE_SELECTED)
         
         # Check if file type is allowed
-        if not allowed_file(image_file.filename):
-            return jsonify({
-                'success': False,
-                'error': f'Invalid file type. Allowed types: {", ".join(ALLOWED_EXTENSIONS)}'
-            }), 400
+        if not allowed_file(image_target.multipart_filename):
+            return error_response(_ERR_INVALID_TYPE)
         
         # Get additional information and label if provided
-        additional_info = request.form.get('additional_info', '')
-        user_label = request.form.get('label', '')
+        additional_info = info_target.value.decode('utf-8', errors='replace')
+        user_label = label_target.value.decode('utf-8', errors='replace')
         
-        # Save uploaded file temporarily
-        filename = secure_filename(image_file.filename)
-        temp_dir = tempfile.gettempdir()
-        temp_path = os.path.join(temp_dir, filename)
+        # Use the part's declared type, falling back to the file extension
+        mime_type = image_target.multipart_content_type
+        if not mime_type or not mime_type.startswith('image/'):
+            mime_type = mimetypes.guess_type(image_target.multipart_filename)[0] or 'image/jpeg'
+        
+        # Push fields as they are generated when the client asks for SSE
+        if wants_stream(stream_target.value.strip().lower() in (b'1', b'true')):
+            return sse_response(_diagnosis_events(image_target.value, mime_type, additional_info, user_label))
+        
+        # Perform diagnosis using OpenAI. The slot is taken only now, so
+        # slow uploads can't hold slots while no vision call is running
+        async with diagnose_slots:
+            diagnosis_result = await openai_client.diagnose_plant(
+                image_target.value, mime_type, additional_info, user_label
+            )
+        
+        body, status = _diagnosis_body(diagnosis_result, additional_info, user_label)
+        return jsonify(body), status
         
-        try:
-            image_file.save(temp_path)
-            
-            # Perform diagnosis using OpenAI
-            diagnosis_result = openai_client.diagnose_plant(temp_path, additional_info, user_label)
-            
-            # Clean up temporary file
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
-            
-            if diagnosis_result.get('success'):
-                return jsonify({
-                    'success': True,
-                    'message': 'Plant diagnosis completed successfully',
-                    'diagnosis': diagnosis_result['data'],
-                    'model_used': openai_client.models['diagnosis']['vision_model'],
-                    'additional_info': additional_info if additional_info else None,
-                    'user_label': user_label if user_label else None
-                }), 200
-            else:
-                return jsonify({
-                    'success': False,
-                    'error': diagnosis_result.get('error', 'Diagnosis failed'),
-                    'raw_response': diagnosis_result.get('raw_response')
-                }), 500
-                
-        except Exception as e:
-            # Clean up temporary file in case of error
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
-            raise e
-            
     except Exception as e:
         return jsonify({
             'success': False,
             'error': f'Server error during diagnosis: {str(e)}'
         }), 500
+
+def _diagnosis_body(diagnosis_result, additional_info, user_label):
+    """Build the response body and status code for a diagnosis result."""
+    if diagnosis_result.get('success'):
+        return {
+            'success': True,
+            'message': 'Plant diagnosis completed successfully',
+            'diagnosis': diagnosis_result['data'],
+            'model_used': openai_client.models['diagnosis']['vision_model'],
+            'additional_info': additional_info if additional_info else None,
+            'user_label': user_label if user_label else None
+        }, 200
+    else:
+        return {
+            'success': False,
+            'error': diagnosis_result.get('error', 'Diagnosis failed'),
+            'raw_response': diagnosis_result.get('raw_response')
+        }, 500
+
+async def _diagnosis_events(image_bytes, mime_type, additional_info, user_label):
+    """
+    Relay a streamed diagnosis as SSE frames.
+    
+    {"field": ..., "value": ...} frames arrive as the model writes each field;
+    the final frame is the usual response body with "done": true.
+    """
+    # The 200 header is already sent, so any error has to end the stream
+    # with a 'done' frame rather than escape the generator
+    try:
+        # Held for the vision call only, as in diagnose_plant
+        async with diagnose_slots:
+            async for event in openai_client.diagnose_plant_stream(image_bytes, mime_type, additional_info, user_label):
+                if event.get('done'):
+                    body, _ = _diagnosis_body(event, additional_info, user_label)
+                    yield sse_event({'done': True, **body})
+                else:
+                    yield sse_event(event)
+    except Exception as e:
+        logger.exception("Diagnosis stream failed")
+        yield sse_event({'done': True, 'success': False, 'error': f'Server error during diagnosis: {str(e)}'})
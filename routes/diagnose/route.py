@@ -1,11 +1,11 @@
 
-from flask import Blueprint
+from quart import Blueprint
 from routes.diagnose.controller import diagnose_plant
 
 diagnose_bp = Blueprint('diagnose', __name__)
 
 @diagnose_bp.route('/diagnose', methods=['POST'])
-def diagnose():
+async def diagnose():
     """Plant diagnosis endpoint - accepts image upload and returns diagnosis."""
-    return diagnose_plant()
+    return await diagnose_plant()
 
@@ -0,0 +1,11 @@
+import orjson
+from quart import Response
+
+def prebuilt_error(message, status):
+    """Serialize a static error body once, at import time."""
+    return orjson.dumps({'success': False, 'error': message}), status
+
+def error_response(prebuilt):
+    """Return a prebuilt error as a JSON response without re-serializing it."""
+    body, status = prebuilt
+    return Response(body, status=status, mimetype='application/json')
@@ -1,15 +1,30 @@
-from flask import request, jsonify
-from services.openai_client import OpenAIClient
+from quart import request, jsonify, current_app, stream_with_context
+from routes.errors import prebuilt_error, error_response
+from routes.streaming import wants_stream, sse_event, sse_response
+from services.openai_client import get_client
+from services.conversation_store import get_conversation_store
 from datetime import datetime
-import uuid
+import time
+from uuid_extensions import uuid7str
 
-# Initialize OpenAI client
-openai_client = OpenAIClient()
+# Shared OpenAI client (one connection pool for the whole app)
+openai_client = get_client()
 
-# In-memory conversation storage (in production, use a database)
-conversations = {}
+# Conversation storage (Redis when REDIS_URL is set, otherwise in-memory)
+conversation_store = get_conversation_store()
 
-def send_message():
+# Messages sent to the model as context. Once a conversation holds twice
+# this many, the older ones are folded into a rolling summary.
+MAX_CONTEXT_MESSAGES = 20
+
+# Static error responses, serialized once
+_ERR_NO_JSON = prebuilt_error('No JSON data provided. Please send a message in JSON format.', 400)
+_ERR_NO_MESSAGE = prebuilt_error('No message provided. Please include a message in your request.', 400)
+_ERR_START_NEW = prebuilt_error('Conversation not found. Please start a new conversation.', 404)
+_ERR_NO_CONVERSATION_ID = prebuilt_error('conversation_id parameter is required', 400)
+_ERR_NOT_FOUND = prebuilt_error('Conversation not found', 404)
+
+async def send_message():
     """
     Handle chat messages with conversation management.
     
@@ -18,6 +33,8 @@ def send_message():
     - 'message' field containing the user's message
     - Optional 'conversation_id' field to continue existing conversation
     - Optional 'user_id' field for user identification
+    - Optional 'stream' field (or an 'Accept: text/event-stream' header) to
+      receive the response as Server-Sent Events while it is generated
     
     Returns:
     - AI response with conversation context
@@ -25,68 +42,63 @@ def send_message():
     """
     try:
         # Get JSON data from request
-        data = request.get_json()
+        data = await request.get_json()
         
         if not data:
-            return jsonify({
-                'success': False,
-                'error': 'No JSON data provided. Please send a message in JSON format.'
-            }), 400
+            return error_response(_ERR_NO_JSON)
         
         # Extract user message
         user_message = data.get('message', '').strip()
         
         if not user_message:
-            return jsonify({
-                'success': False,
-                'error': 'No message provided. Please include a message in your request.'
-            }), 400
+            return error_response(_ERR_NO_MESSAGE)
+        
+        # One clock read for everything this request records: the epoch
+        # nanoseconds order conversations, the ISO string is what clients see
+        activity_ts = time.time_ns()
+        timestamp = datetime.fromtimestamp(activity_ts / 1e9).isoformat()
         
         # Get or create conversation ID
         conversation_id = data.get('conversation_id')
         user_id = data.get('user_id', 'anonymous')
         
         if not conversation_id:
-            # Create new conversation
-            conversation_id = str(uuid.uuid4())
-            conversations[conversation_id] = {
-                'user_id': user_id,
-                'created_at': datetime.now().isoformat(),
-                'last_activity': datetime.now().isoformat(),
-                'messages': []
-            }
+            # Create new conversation (UUIDv7: IDs sort by creation time)
+            conversation_id = uuid7str()
+            await conversation_store.create_conversation(conversation_id, user_id, timestamp, activity_ts)
         
         # Check if conversation exists
-        if conversation_id not in conversations:
-            return jsonify({
-                'success': False,
-                'error': 'Conversation not found. Please start a new conversation.'
-            }), 404
+        conversation = await conversation_store.get_conversation(conversation_id)
+        if conversation is None:
+            return error_response(_ERR_START_NEW)
         
-        # Get conversation history
-        conversation = conversations[conversation_id]
-        conversation_history = conversation['messages']
+        # Get recent conversation history, prefixed by the summary of older turns
+        conversation_history = await conversation_store.get_messages(conversation_id, limit=MAX_CONTEXT_MESSAGES)
+        if conversation.get('summary'):
+            conversation_history.insert(0, {
+                'role': 'system',
+                'content': f"Summary of the earlier conversation: {conversation['summary']}"
+            })
+        
+        # Update last activity (the conversation may have been deleted meanwhile)
+        if not await conversation_store.touch(conversation_id, conversation['user_id'], timestamp, activity_ts):
+            return error_response(_ERR_NOT_FOUND)
         
-        # Update last activity
-        conversation['last_activity'] = datetime.now().isoformat()
+        # Stream tokens as they arrive when the client asks for SSE
+        if wants_stream(data.get('stream')):
+            return _stream_response(
+                conversation_id, conversation, user_message, conversation_history, timestamp, activity_ts
+            )
         
         # Chat with AI using RAG
-        chat_result = openai_client.chat_with_ai(user_message, conversation_history)
+        chat_result = await openai_client.chat_with_ai(user_message, conversation_history)
         
         if chat_result.get('success'):
-            # Add user message to conversation
-            conversation['messages'].append({
-                'role': 'user',
-                'content': user_message,
-                'timestamp': datetime.now().isoformat()
-            })
-            
-            # Add AI response to conversation
-            conversation['messages'].append({
-                'role': 'assistant',
-                'content': chat_result['response'],
-                'timestamp': datetime.now().isoformat()
-            })
+            # Add user message and AI response to conversation
+            if not await _save_exchange(
+                conversation_id, conversation, user_message, chat_result['response'], timestamp, activity_ts
+            ):
+                return error_response(_ERR_NOT_FOUND)
             
             return jsonify({
                 'success': True,
@@ -94,7 +106,7 @@ def send_message():
                 'conversation_id': conversation_id,
                 'response': chat_result['response'],
                 'model_used': chat_result['model_used'],
-                'timestamp': datetime.now().isoformat()
+                'timestamp': timestamp
             }), 200
         else:
             return jsonify({
@@ -109,7 +121,97 @@ def send_message():
             'error': f'Server error during message processing: {str(e)}'
         }), 500
 
-def get_conversation():
+def _stream_response(conversation_id, conversation, user_message, conversation_history, timestamp, activity_ts):
+    """
+    Stream the AI response as Server-Sent Events.
+    
+    Each piece of text arrives as {"delta": "..."}; the final event is
+    {"done": true, ...} with the conversation_id once the exchange is saved.
+    Nothing is stored if the client disconnects mid-stream.
+    """
+    # Keep the request context so the save can schedule background work
+    @stream_with_context
+    async def generate():
+        response_parts = []
+        try:
+            async for delta in openai_client.stream_chat(user_message, conversation_history):
+                response_parts.append(delta)
+                yield sse_event({'delta': delta})
+        except Exception as e:
+            yield sse_event({'done': True, 'success': False, 'error': f'Chat error: {str(e)}'})
+            return
+        
+        # Persist only the complete reply
+        if not await _save_exchange(
+            conversation_id, conversation, user_message, ''.join(response_parts), timestamp, activity_ts
+        ):
+            yield sse_event({'done': True, 'success': False, 'error': 'Conversation not found'})
+            return
+        
+        yield sse_event({
+            'done': True,
+            'success': True,
+            'conversation_id': conversation_id,
+            'model_used': openai_client.models['chat']['primary_model'],
+            'timestamp': timestamp
+        })
+    
+    return sse_response(generate())
+
+async def _save_exchange(conversation_id, conversation, user_message, ai_response, timestamp, activity_ts):
+    """
+    Store a user message and its reply, compacting the conversation when it grows too long.
+    
+    Returns False if the conversation was deleted while the reply was generated.
+    """
+    message_count = await conversation_store.append_messages(conversation_id, conversation['user_id'], [
+        {
+            'role': 'user',
+            'content': user_message,
+            'timestamp': timestamp
+        },
+        {
+            'role': 'assistant',
+            'content': ai_response,
+            'timestamp': timestamp
+        }
+    ], timestamp, activity_ts)
+    
+    if message_count is None:
+        return False
+    
+    if message_count > MAX_CONTEXT_MESSAGES * 2:
+        # Summarize after the response, so the reply doesn't wait on it
+        current_app.add_background_task(_compact_conversation, conversation_id)
+    
+    return True
+
+async def _compact_conversation(conversation_id):
+    """Summarize all but the most recent messages and drop them from storage."""
+    # Only one compaction per conversation at a time: two overlapping ones
+    # would both trim the same messages from the front
+    if not await conversation_store.claim_compaction(conversation_id):
+        return
+    
+    try:
+        # Read the summary now rather than at request time, so it includes
+        # any compaction that finished in between
+        conversation = await conversation_store.get_conversation(conversation_id)
+        if conversation is None:
+            return
+        
+        messages = await conversation_store.get_messages(conversation_id)
+        older_messages = messages[:-MAX_CONTEXT_MESSAGES]
+        if not older_messages:
+            return
+        
+        summary = await openai_client.summarize_conversation(older_messages, conversation.get('summary'))
+        if summary:
+            await conversation_store.compact(conversation_id, summary, len(older_messages))
+    finally:
+        await conversation_store.release_compaction(conversation_id)
+
+async def get_conversation():
     """
     Get conversation history for a specific conversation ID.
     
@@ -123,18 +225,13 @@ def get_conversation():
         conversation_id = request.args.get('conversation_id')
         
         if not conversation_id:
-            return jsonify({
-                'success': False,
-                'error': 'conversation_id parameter is required'
-            }), 400
+            return error_response(_ERR_NO_CONVERSATION_ID)
         
-        if conversation_id not in conversations:
-            return jsonify({
-                'success': False,
-                'error': 'Conversation not found'
-            }), 404
+        conversation = await conversation_store.get_conversation(conversation_id)
+        if conversation is None:
+            return error_response(_ERR_NOT_FOUND)
         
-        conversation = conversations[conversation_id]
+        messages = await conversation_store.get_messages(conversation_id)
         
         return jsonify({
             'success': True,
@@ -142,8 +239,9 @@ def get_conversation():
             'user_id': conversation['user_id'],
             'created_at': conversation['created_at'],
             'last_activity': conversation['last_activity'],
-            'message_count': len(conversation['messages']),
-            'messages': conversation['messages']
+            'message_count': len(messages),
+            'summary': conversation.get('summary'),
+            'messages': messages
         }), 200
         
     except Exception as e:
@@ -152,7 +250,7 @@ def get_conversation():
             'error': f'Server error retrieving conversation: {str(e)}'
         }), 500
 
-def get_user_conversations():
+async def get_user_conversations():
     """
     Get all conversations for a specific user.
     
@@ -165,19 +263,8 @@ def get_user_conversations():
     try:
         user_id = request.args.get('user_id', 'anonymous')
         
-        user_conversations = []
-        for conv_id, conv_data in conversations.items():
-            if conv_data['user_id'] == user_id:
-                user_conversations.append({
-                    'conversation_id': conv_id,
-                    'created_at': conv_data['created_at'],
-                    'last_activity': conv_data['last_activity'],
-                    'message_count': len(conv_data['messages']),
-                    'last_message': conv_data['messages'][-1]['content'] if conv_data['messages'] else None
-                })
-        
-        # Sort by last activity (most recent first)
-        user_conversations.sort(key=lambda x: x['last_activity'], reverse=True)
+        # Most recent first
+        user_conversations = await conversation_store.get_user_conversations(user_id)
         
         return jsonify({
             'success': True,
@@ -192,7 +279,7 @@ def get_user_conversations():
             'error': f'Server error retrieving user conversations: {str(e)}'
         }), 500
 
-def delete_conversation():
+async def delete_conversation():
     """
     Delete a specific conversation.
     
@@ -206,19 +293,11 @@ def delete_conversation():
         conversation_id = request.args.get('conversation_id')
         
         if not conversation_id:
-            return jsonify({
-                'success': False,
-                'error': 'conversation_id parameter is required'
-            }), 400
-        
-        if conversation_id not in conversations:
-            return jsonify({
-                'success': False,
-                'error': 'Conversation not found'
-            }), 404
+            return error_response(_ERR_NO_CONVERSATION_ID)
         
         # Delete conversation
-        del conversations[conversation_id]
+        if not await conversation_store.delete_conversation(conversation_id):
+            return error_response(_ERR_NOT_FOUND)
         
         return jsonify({
             'success': True,
@@ -232,7 +311,7 @@ def delete_conversation():
             'error': f'Server error deleting conversation: {str(e)}'
         }), 500
 
-def clear_all_conversations():
+async def clear_all_conversations():
     """
     Clear all conversations (admin function).
     
@@ -240,8 +319,7 @@ def clear_all_conversations():
     - Confirmation of clearing all conversations
     """
     try:
-        conversation_count = len(conversations)
-        conversations.clear()
+        conversation_count = await conversation_store.clear()
         
         return jsonify({
             'success': True,
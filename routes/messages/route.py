@@ -1,4 +1,4 @@
-from flask import Blueprint
+from quart import Blueprint
 from routes.messages.controller import (
     send_message,
     get_conversation,
@@ -10,7 +10,7 @@ from routes.messages.controller import (
 messages_bp = Blueprint('messages', __name__)
 
 @messages_bp.route('/messages', methods=['POST'])
-def send_message_endpoint():
+async def send_message_endpoint():
     """
     Send a message to the AI assistant.
     
@@ -18,9 +18,14 @@ def send_message_endpoint():
     {
         "message": "Your message here",
         "conversation_id": "optional-existing-conversation-id",
-        "user_id": "optional-user-identifier"
+        "user_id": "optional-user-identifier",
+        "stream": false
     }
     
+    With "stream": true (or an "Accept: text/event-stream" header) the reply
+    is sent as Server-Sent Events: {"delta": "..."} frames followed by a
+    final {"done": true, "conversation_id": "...", ...} frame.
+    
     Response:
     {
         "success": true,
@@ -31,10 +36,10 @@ def send_message_endpoint():
         "timestamp": "2024-01-01T12:00:00"
     }
     """
-    return send_message()
+    return await send_message()
 
 @messages_bp.route('/messages/conversation', methods=['GET'])
-def get_conversation_endpoint():
+async def get_conversation_endpoint():
     """
     Get conversation history for a specific conversation.
     
@@ -49,13 +54,14 @@ def get_conversation_endpoint():
         "created_at": "2024-01-01T12:00:00",
         "last_activity": "2024-01-01T12:30:00",
         "message_count": 10,
+        "summary": "Summary of older, compacted messages (or null)",
         "messages": [...]
     }
     """
-    return get_conversation()
+    return await get_conversation()
 
 @messages_bp.route('/messages/conversations', methods=['GET'])
-def get_user_conversations_endpoint():
+async def get_user_conversations_endpoint():
     """
     Get all conversations for a specific user.
     
@@ -70,10 +76,10 @@ def get_user_conversations_endpoint():
         "conversations": [...]
     }
     """
-    return get_user_conversations()
+    return await get_user_conversations()
 
 @messages_bp.route('/messages/conversation', methods=['DELETE'])
-def delete_conversation_endpoint():
+async def delete_conversation_endpoint():
     """
     Delete a specific conversation.
     
@@ -87,10 +93,10 @@ def delete_conversation_endpoint():
         "conversation_id": "conversation-uuid"
     }
     """
-    return delete_conversation()
+    return await delete_conversation()
 
 @messages_bp.route('/messages/clear', methods=['DELETE'])
-def clear_all_conversations_endpoint():
+async def clear_all_conversations_endpoint():
     """
     Clear all conversations (admin function).
     
@@ -101,4 +107,4 @@ def clear_all_conversations_endpoint():
         "deleted_count": 25
     }
     """
-    return clear_all_conversations()
+    return await clear_all_conversations()
@@ -0,0 +1,21 @@
+import orjson
+from quart import request, Response
+
+def wants_stream(requested=False) -> bool:
+    """Check whether the client asked for Server-Sent Events (flag or Accept header)."""
+    # Only an explicit true counts, so "false" or "0" from a client doesn't stream
+    if isinstance(requested, str):
+        requested = requested.strip().lower()
+    return requested in (True, 'true', '1') or 'text/event-stream' in request.headers.get('Accept', '')
+
+def sse_event(payload) -> bytes:
+    """Format a payload as a Server-Sent Events data frame."""
+    return b'data: ' + orjson.dumps(payload) + b'\n\n'
+
+def sse_response(events):
+    """Return an async generator of SSE frames as a streaming response."""
+    response = Response(events, mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # don't let nginx buffer the events
+    response.timeout = None  # long answers may outlast Quart's response timeout
+    return response
@@ -0,0 +1,388 @@
+import os
+import orjson
+from collections import OrderedDict, defaultdict
+from typing import Dict, Any, Optional, List
+from services.redis_client import get_redis
+
+# Idle conversations expire after this many seconds (Redis store only)
+CONVERSATION_TTL = int(os.getenv('CONVERSATION_TTL', 7 * 86400))
+
+# Length of the last-message preview kept for conversation listings
+LAST_MESSAGE_PREVIEW = 200
+
+# A compaction claim lapses after this many seconds, in case the worker
+# holding it dies before releasing it (Redis store only)
+COMPACTION_LOCK_TTL = 120
+
+# Conversation updates run as Lua scripts so the existence check and the
+# writes are atomic: writing to a conversation deleted mid-request would
+# otherwise recreate a meta hash without user_id or created_at.
+# KEYS: meta, msgs, user index. ARGV: ttl, conversation_id, timestamp, activity_ts, ...
+_TOUCH_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'last_activity', ARGV[3], 'last_activity_ts', ARGV[4])
+redis.call('ZADD', KEYS[3], ARGV[4], ARGV[2])
+for i = 1, 3 do
+    redis.call('EXPIRE', KEYS[i], ARGV[1])
+end
+return 1
+"""
+
+# ARGV continues with the last_message preview, then the encoded messages
+_APPEND_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return -1
+end
+local message_count = redis.call('RPUSH', KEYS[2], unpack(ARGV, 6))
+redis.call('HSET', KEYS[1], 'last_activity', ARGV[3], 'last_activity_ts', ARGV[4], 'last_message', ARGV[5])
+redis.call('ZADD', KEYS[3], ARGV[4], ARGV[2])
+for i = 1, 3 do
+    redis.call('EXPIRE', KEYS[i], ARGV[1])
+end
+return message_count
+"""
+
+# KEYS: meta, msgs. ARGV: summary, summarized_count
+_COMPACT_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'summary', ARGV[1])
+redis.call('LTRIM', KEYS[2], ARGV[2], -1)
+return 1
+"""
+
+class InMemoryConversationStore:
+    """
+    Process-local conversation storage.
+
+    Used when REDIS_URL is not configured. State is lost on restart and is
+    not shared between workers, so only run a single worker with this store.
+    """
+
+    def __init__(self):
+        self.conversations = {}
+        # user_id -> conversation IDs ordered by last activity (oldest first),
+        # so per-user listing never scans or sorts every conversation
+        self.user_index = defaultdict(OrderedDict)
+        # Conversations with a compaction in progress
+        self.compacting = set()
+
+    async def create_conversation(self, conversation_id: str, user_id: str, timestamp: str, activity_ts: int) -> None:
+        """Create an empty conversation owned by user_id."""
+        self.conversations[conversation_id] = {
+            'user_id': user_id,
+            'created_at': timestamp,
+            'last_activity': timestamp,
+            'last_activity_ts': activity_ts,
+            'last_message': None,
+            'summary': None,
+            'messages': []
+        }
+        self.user_index[user_id][conversation_id] = None
+
+    async def get_conversation(self, conversation_id: str) -> Optional[Dict[str, Any]]:
+        """Return conversation metadata (without messages), or None if missing."""
+        conversation = self.conversations.get(conversation_id)
+        if conversation is None:
+            return None
+
+        return {
+            'user_id': conversation['user_id'],
+            'created_at': conversation['created_at'],
+            'last_activity': conversation['last_activity'],
+            'summary': conversation['summary']
+        }
+
+    async def get_messages(self, conversation_id: str, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Return a copy of the conversation's messages (the last `limit` if given), oldest first."""
+        conversation = self.conversations.get(conversation_id)
+        if not conversation:
+            return []
+        return conversation['messages'][-limit:] if limit else list(conversation['messages'])
+
+    async def touch(self, conversation_id: str, user_id: str, timestamp: str, activity_ts: int) -> bool:
+        """Update the conversation's last activity time. Returns False if it no longer exists."""
+        conversation = self.conversations.get(conversation_id)
+        if conversation is None:
+            return False
+
+        conversation['last_activity'] = timestamp
+        conversation['last_activity_ts'] = activity_ts
+        self.user_index[user_id].move_to_end(conversation_id)
+        return True
+
+    async def append_messages(self, conversation_id: str, user_id: str, messages: List[Dict[str, Any]], timestamp: str, activity_ts: int) -> Optional[int]:
+        """
+        Append messages, update last activity, and return the new message count.
+
+        Returns None without writing if the conversation was deleted or
+        cleared meanwhile (e.g. while the AI reply was being generated).
+        """
+        conversation = self.conversations.get(conversation_id)
+        if conversation is None:
+            return None
+
+        conversation['messages'].extend(messages)
+        conversation['last_activity'] = timestamp
+        conversation['last_activity_ts'] = activity_ts
+        conversation['last_message'] = messages[-1]['content'][:LAST_MESSAGE_PREVIEW]
+        self.user_index[user_id].move_to_end(conversation_id)
+        return len(conversation['messages'])
+
+    async def claim_compaction(self, conversation_id: str) -> bool:
+        """Mark the conversation as being compacted. Returns False if a compaction is already running."""
+        if conversation_id in self.compacting:
+            return False
+
+        self.compacting.add(conversation_id)
+        return True
+
+    async def release_compaction(self, conversation_id: str) -> None:
+        """Release a claim taken with claim_compaction."""
+        self.compacting.discard(conversation_id)
+
+    async def compact(self, conversation_id: str, summary: str, summarized_count: int) -> None:
+        """Replace the oldest summarized_count messages with a summary."""
+        conversation = self.conversations.get(conversation_id)
+        if conversation is not None:
+            conversation['summary'] = summary
+            del conversation['messages'][:summarized_count]
+
+    async def get_user_conversations(self, user_id: str) -> List[Dict[str, Any]]:
+        """Return summaries of the user's conversations, most recent first."""
+        user_conversations = []
+        for conv_id in reversed(self.user_index.get(user_id, ())):
+            conv_data = self.conversations[conv_id]
+            user_conversations.append({
+                'conversation_id': conv_id,
+                'created_at': conv_data['created_at'],
+                'last_activity': conv_data['last_activity'],
+                'message_count': len(conv_data['messages']),
+                'last_message': conv_data['last_message']
+            })
+
+        return user_conversations
+
+    async def delete_conversation(self, conversation_id: str) -> bool:
+        """Delete a conversation. Returns False if it did not exist."""
+        conversation = self.conversations.pop(conversation_id, None)
+        if conversation is None:
+            return False
+
+        user_conversations = self.user_index[conversation['user_id']]
+        del user_conversations[conversation_id]
+        if not user_conversations:
+            del self.user_index[conversation['user_id']]
+
+        return True
+
+    async def clear(self) -> int:
+        """Delete every conversation and return how many were removed."""
+        conversation_count = len(self.conversations)
+        # Swap in fresh containers instead of clearing in place: the swap is
+        # O(1), and the old generation is freed by the garbage collector.
+        # Requests still in flight look their conversation up again before
+        # writing, find it gone and report it as not found
+        self.conversations = {}
+        self.user_index = defaultdict(OrderedDict)
+        return conversation_count
+
+class RedisConversationStore:
+    """
+    Redis-backed conversation storage shared by all workers.
+
+    Keys:
+    - conv:{id}:meta       hash with user_id, created_at, last_activity,
+                           last_activity_ts, a last_message preview and the
+                           summary of compacted messages
+    - conv:{id}:msgs       list of JSON-encoded messages
+    - conv:{id}:compacting claim held while a compaction runs
+    - user:{uid}:convs     sorted set of conversation IDs scored by last_activity_ts
+    """
+
+    def __init__(self, redis):
+        self.redis = redis
+        self._touch_script = redis.register_script(_TOUCH_SCRIPT)
+        self._append_script = redis.register_script(_APPEND_SCRIPT)
+        self._compact_script = redis.register_script(_COMPACT_SCRIPT)
+
+    @staticmethod
+    def _meta_key(conversation_id: str) -> str:
+        return f"conv:{conversation_id}:meta"
+
+    @staticmethod
+    def _messages_key(conversation_id: str) -> str:
+        return f"conv:{conversation_id}:msgs"
+
+    @staticmethod
+    def _user_key(user_id: str) -> str:
+        return f"user:{user_id}:convs"
+
+    @staticmethod
+    def _compaction_key(conversation_id: str) -> str:
+        return f"conv:{conversation_id}:compacting"
+
+    def _refresh_expiry(self, pipe, conversation_id: str, user_id: str) -> None:
+        """Queue EXPIRE commands so idle conversations age out together."""
+        pipe.expire(self._meta_key(conversation_id), CONVERSATION_TTL)
+        pipe.expire(self._messages_key(conversation_id), CONVERSATION_TTL)
+        pipe.expire(self._user_key(user_id), CONVERSATION_TTL)
+
+    async def create_conversation(self, conversation_id: str, user_id: str, timestamp: str, activity_ts: int) -> None:
+        """Create an empty conversation owned by user_id."""
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(self._meta_key(conversation_id), mapping={
+                'user_id': user_id,
+                'created_at': timestamp,
+                'last_activity': timestamp,
+                'last_activity_ts': activity_ts
+            })
+            pipe.zadd(self._user_key(user_id), {conversation_id: activity_ts})
+            self._refresh_expiry(pipe, conversation_id, user_id)
+            await pipe.execute()
+
+    async def get_conversation(self, conversation_id: str) -> Optional[Dict[str, Any]]:
+        """Return conversation metadata (without messages), or None if missing."""
+        meta = await self.redis.hgetall(self._meta_key(conversation_id))
+        return meta or None
+
+    async def get_messages(self, conversation_id: str, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Return the conversation's messages (the last `limit` if given), oldest first."""
+        start = -limit if limit else 0
+        raw_messages = await self.redis.lrange(self._messages_key(conversation_id), start, -1)
+        return [orjson.loads(message) for message in raw_messages]
+
+    def _conversation_keys(self, conversation_id: str, user_id: str) -> List[str]:
+        return [self._meta_key(conversation_id), self._messages_key(conversation_id), self._user_key(user_id)]
+
+    async def touch(self, conversation_id: str, user_id: str, timestamp: str, activity_ts: int) -> bool:
+        """Update the conversation's last activity time and extend its expiry. Returns False if it no longer exists."""
+        touched = await self._touch_script(
+            keys=self._conversation_keys(conversation_id, user_id),
+            args=[CONVERSATION_TTL, conversation_id, timestamp, activity_ts]
+        )
+        return bool(touched)
+
+    async def append_messages(self, conversation_id: str, user_id: str, messages: List[Dict[str, Any]], timestamp: str, activity_ts: int) -> Optional[int]:
+        """
+        Append messages, update last activity, and return the new message count.
+
+        Returns None without writing if the conversation was deleted or
+        expired meanwhile, so no partial conversation is recreated.
+        """
+        message_count = await self._append_script(
+            keys=self._conversation_keys(conversation_id, user_id),
+            args=[
+                CONVERSATION_TTL, conversation_id, timestamp, activity_ts,
+                messages[-1]['content'][:LAST_MESSAGE_PREVIEW],
+                *[orjson.dumps(message) for message in messages]
+            ]
+        )
+        return message_count if message_count >= 0 else None
+
+    async def claim_compaction(self, conversation_id: str) -> bool:
+        """Mark the conversation as being compacted. Returns False if a compaction is already running."""
+        # SET NX makes the claim exclusive across workers
+        claimed = await self.redis.set(self._compaction_key(conversation_id), 1, nx=True, ex=COMPACTION_LOCK_TTL)
+        return bool(claimed)
+
+    async def release_compaction(self, conversation_id: str) -> None:
+        """Release a claim taken with claim_compaction."""
+        await self.redis.delete(self._compaction_key(conversation_id))
+
+    async def compact(self, conversation_id: str, summary: str, summarized_count: int) -> None:
+        """Replace the oldest summarized_count messages with a summary."""
+        # Trims from the front so messages appended meanwhile are kept
+        await self._compact_script(
+            keys=[self._meta_key(conversation_id), self._messages_key(conversation_id)],
+            args=[summary, summarized_count]
+        )
+
+    async def get_user_conversations(self, user_id: str) -> List[Dict[str, Any]]:
+        """Return summaries of the user's conversations, most recent first."""
+        user_key = self._user_key(user_id)
+        conversation_ids = await self.redis.zrevrange(user_key, 0, -1)
+        if not conversation_ids:
+            return []
+
+        # Only summary fields are read; message lists are never loaded
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for conv_id in conversation_ids:
+                pipe.hmget(self._meta_key(conv_id), 'created_at', 'last_activity', 'last_message')
+                pipe.llen(self._messages_key(conv_id))
+            results = await pipe.execute()
+
+        user_conversations = []
+        expired_ids = []
+        for index, conv_id in enumerate(conversation_ids):
+            (created_at, last_activity, last_message), message_count = results[index * 2:index * 2 + 2]
+            if created_at is None:
+                # Conversation expired; drop the dangling index entry
+                expired_ids.append(conv_id)
+                continue
+
+            user_conversations.append({
+                'conversation_id': conv_id,
+                'created_at': created_at,
+                'last_activity': last_activity,
+                'message_count': message_count,
+                'last_message': last_message
+            })
+
+        if expired_ids:
+            await self.redis.zrem(user_key, *expired_ids)
+
+        return user_conversations
+
+    async def delete_conversation(self, conversation_id: str) -> bool:
+        """Delete a conversation. Returns False if it did not exist."""
+        user_id = await self.redis.hget(self._meta_key(conversation_id), 'user_id')
+        if user_id is None:
+            return False
+
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.delete(self._meta_key(conversation_id), self._messages_key(conversation_id))
+            pipe.zrem(self._user_key(user_id), conversation_id)
+            await pipe.execute()
+
+        return True
+
+    async def clear(self) -> int:
+        """Delete every conversation and return how many were removed."""
+        conversation_count = 0
+
+        for pattern in ('conv:*', 'user:*:convs'):
+            batch = []
+            async for key in self.redis.scan_iter(match=pattern, count=500):
+                if key.endswith(':meta'):
+                    conversation_count += 1
+                batch.append(key)
+                if len(batch) >= 500:
+                    await self._delete_keys(batch)
+                    batch = []
+            if batch:
+                await self._delete_keys(batch)
+
+        return conversation_count
+
+    async def _delete_keys(self, keys: List[str]) -> None:
+        """Delete a batch of keys in a single round trip."""
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.unlink(key)
+            await pipe.execute()
+
+_store = None
+
+def get_conversation_store():
+    """Return the shared conversation store (Redis when REDIS_URL is set)."""
+    global _store
+
+    if _store is None:
+        redis = get_redis()
+        _store = RedisConversationStore(redis) if redis is not None else InMemoryConversationStore()
+
+    return _store
@@ -0,0 +1,71 @@
+"""
+CPU-bound image preparation for the vision model.
+
+Kept free of app state and heavy imports so OpenAIClient can run these
+functions in worker processes.
+"""
+
+import io
+from typing import Tuple
+from PIL import Image, ImageOps
+
+# pybase64 uses SIMD (SSSE3/AVX2/NEON) and is several times faster than the
+# stdlib on multi-MB images; fall back to the stdlib where no wheel exists
+try:
+    from pybase64 import b64encode, b64encode_as_string
+except ImportError:
+    from base64 import b64encode
+
+    def b64encode_as_string(data: bytes) -> str:
+        return b64encode(data).decode('ascii')
+
+# Images are downscaled to this long edge and re-encoded as JPEG before
+# upload: fewer bytes on the wire and fewer image tokens billed
+MAX_IMAGE_EDGE = 768
+IMAGE_JPEG_QUALITY = 80
+
+# Bytes encoded per step when building a data URL (a multiple of 3, so
+# no padding is emitted mid-stream)
+ENCODE_CHUNK = 57 * 1024
+
+def downscale_image(image_bytes: bytes, mime_type: str) -> Tuple[bytes, str]:
+    """Shrink images larger than MAX_IMAGE_EDGE; smaller or unreadable images pass through."""
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            if max(image.size) <= MAX_IMAGE_EDGE:
+                return image_bytes, mime_type
+            
+            # Let the JPEG decoder scale down while decoding
+            image.draft('RGB', (MAX_IMAGE_EDGE, MAX_IMAGE_EDGE))
+            
+            # Phone photos are often stored sideways with an EXIF rotation
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((MAX_IMAGE_EDGE, MAX_IMAGE_EDGE))
+            
+            if 'A' in image.getbands():
+                # JPEG has no alpha: flatten transparency onto white
+                flattened = Image.new('RGB', image.size, (255, 255, 255))
+                flattened.paste(image, mask=image.getchannel('A'))
+                image = flattened
+            
+            output = io.BytesIO()
+            image.convert('RGB').save(output, 'JPEG', quality=IMAGE_JPEG_QUALITY, optimize=True)
+            return output.getvalue(), 'image/jpeg'
+            
+    except (OSError, Image.DecompressionBombError):
+        # Formats Pillow can't read are sent as uploaded
+        return image_bytes, mime_type
+
+def encode_data_url(image_bytes: bytes, mime_type: str) -> str:
+    """Base64-encode an image straight into its data URL."""
+    # Encoding chunks into one buffer that already holds the prefix skips
+    # the intermediate base64 bytes and str copies of the whole image
+    view = memoryview(image_bytes)
+    buffer = bytearray(f"data:{mime_type};base64,".encode('ascii'))
+    for start in range(0, len(view), ENCODE_CHUNK):
+        buffer += b64encode(view[start:start + ENCODE_CHUNK])
+    return buffer.decode('ascii')
+
+def prepare_data_url(image_bytes: bytes, mime_type: str) -> str:
+    """Downscale an image if needed and return it as a base64 data URL."""
+    return encode_data_url(*downscale_image(image_bytes, mime_type))
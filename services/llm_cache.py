@@ -0,0 +1,172 @@
+import os
+import uuid
+import hashlib
+import orjson
+from array import array
+from typing import Dict, Any, Optional, Tuple
+from openai import APIError
+from redis.exceptions import RedisError, ResponseError
+
+# Exact and semantic cache entries expire after this many seconds
+LLM_CACHE_TTL = int(os.getenv('LLM_CACHE_TTL', 3600))
+
+# Diagnoses of the same image are reused for this many seconds
+DIAGNOSIS_CACHE_TTL = int(os.getenv('DIAGNOSIS_CACHE_TTL', 86400))
+
+# Maximum cosine distance for a semantic cache hit
+LLM_SEMANTIC_THRESHOLD = float(os.getenv('LLM_SEMANTIC_THRESHOLD', 0.15))
+
+# Messages shorter than this (after normalizing) skip the semantic tier;
+# embedding "ok" or "?" costs an API call and can't match meaningfully
+SEMANTIC_MIN_CHARS = 3
+
+EMBEDDING_MODEL = 'text-embedding-3-small'
+EMBEDDING_DIM = 1536
+
+SEMANTIC_INDEX = 'llm_idx'
+SEMANTIC_PREFIX = 'llm:sem:'
+
+class LLMResponseCache:
+    """
+    Two-tier cache for chat completions, stored in Redis.
+
+    1. Exact tier: SHA-1 of the normalized message plus the last two history
+       turns, so a repeated question in the same context is served directly.
+    2. Semantic tier: nearest-neighbour search over message embeddings with
+       RediSearch, so paraphrases of an earlier question reuse its answer.
+       Only used for messages without history, since an answer given inside
+       one conversation doesn't carry over to another. Disabled automatically
+       when the Redis server has no search module.
+
+    Diagnoses are cached by a BLAKE2b hash of the image bytes plus the user's
+    label and notes, so a retried or duplicated upload skips the vision call.
+    """
+
+    def __init__(self, redis, openai_client):
+        self.redis = redis
+        self.openai_client = openai_client
+        self.semantic_enabled = True
+        self._index_ready = False
+
+    @staticmethod
+    def _normalize(text: str) -> str:
+        return ' '.join(text.lower().split())
+
+    def _exact_key(self, user_message: str, conversation_history: Optional[list]) -> str:
+        history_tail = [
+            {'role': message.get('role'), 'content': message.get('content')}
+            for message in (conversation_history or [])[-2:]
+        ]
+        digest = hashlib.sha1(
+            self._normalize(user_message).encode('utf-8') + orjson.dumps(history_tail)
+        ).hexdigest()
+        return f"llm:exact:{digest}"
+
+    async def lookup(self, user_message: str, conversation_history: Optional[list] = None) -> Tuple[Optional[str], Optional[bytes]]:
+        """
+        Look up a cached response.
+
+        Returns:
+            Tuple of (cached response or None, query embedding or None). The
+            embedding is passed back to store() so a miss isn't embedded twice.
+        """
+        try:
+            cached = await self.redis.get(self._exact_key(user_message, conversation_history))
+            if cached is not None:
+                return cached, None
+
+            if conversation_history or len(self._normalize(user_message)) < SEMANTIC_MIN_CHARS:
+                return None, None
+
+            if not await self._ensure_index():
+                return None, None
+
+            embedding = await self._embed(user_message)
+            results = await self.redis.execute_command(
+                'FT.SEARCH', SEMANTIC_INDEX,
+                '*=>[KNN 1 @vec $vec AS score]',
+                'PARAMS', 2, 'vec', embedding,
+                'SORTBY', 'score',
+                'RETURN', 2, 'score', 'response',
+                'LIMIT', 0, 1,
+                'DIALECT', 2
+            )
+
+            if results and results[0]:
+                fields = dict(zip(results[2][::2], results[2][1::2]))
+                if float(fields['score']) < LLM_SEMANTIC_THRESHOLD:
+                    return fields['response'], embedding
+
+            return None, embedding
+
+        except (RedisError, APIError):
+            return None, None
+
+    async def store(self, user_message: str, conversation_history: Optional[list], response: str, embedding: Optional[bytes] = None) -> None:
+        """Cache a response in the exact tier, and in the semantic tier if it has an embedding."""
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.set(self._exact_key(user_message, conversation_history), response, ex=LLM_CACHE_TTL)
+
+                if embedding is not None and not conversation_history:
+                    key = f"{SEMANTIC_PREFIX}{uuid.uuid4().hex}"
+                    pipe.hset(key, mapping={'vec': embedding, 'response': response})
+                    pipe.expire(key, LLM_CACHE_TTL)
+
+                await pipe.execute()
+
+        except RedisError:
+            pass
+
+    @staticmethod
+    def _diagnosis_key(image_bytes: bytes, additional_info: Optional[str], user_label: Optional[str]) -> str:
+        image_digest = hashlib.blake2b(image_bytes, digest_size=16).hexdigest()
+        context_digest = hashlib.blake2b(
+            orjson.dumps([user_label or '', additional_info or '']), digest_size=8
+        ).hexdigest()
+        return f"diag:{image_digest}:{context_digest}"
+
+    async def get_diagnosis(self, image_bytes: bytes, additional_info: Optional[str] = None, user_label: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """Return a cached diagnosis result for this image and context, if any."""
+        try:
+            cached = await self.redis.get(self._diagnosis_key(image_bytes, additional_info, user_label))
+            return orjson.loads(cached) if cached is not None else None
+        except RedisError:
+            return None
+
+    async def store_diagnosis(self, image_bytes: bytes, additional_info: Optional[str], user_label: Optional[str], result: Dict[str, Any]) -> None:
+        """Cache a diagnosis result for this image and context."""
+        try:
+            await self.redis.set(
+                self._diagnosis_key(image_bytes, additional_info, user_label),
+                orjson.dumps(result),
+                ex=DIAGNOSIS_CACHE_TTL
+            )
+        except RedisError:
+            pass
+
+    async def _embed(self, text: str) -> bytes:
+        """Embed text and pack it as a FLOAT32 blob for RediSearch."""
+        result = await self.openai_client.embeddings.create(model=EMBEDDING_MODEL, input=text)
+        return array('f', result.data[0].embedding).tobytes()
+
+    async def _ensure_index(self) -> bool:
+        """Create the HNSW vector index once; disable the semantic tier if unsupported."""
+        if self._index_ready or not self.semantic_enabled:
+            return self._index_ready
+
+        try:
+            await self.redis.execute_command(
+                'FT.CREATE', SEMANTIC_INDEX,
+                'ON', 'HASH', 'PREFIX', 1, SEMANTIC_PREFIX,
+                'SCHEMA', 'vec', 'VECTOR', 'HNSW', 6,
+                'TYPE', 'FLOAT32', 'DIM', EMBEDDING_DIM, 'DISTANCE_METRIC', 'COSINE'
+            )
+        except ResponseError as e:
+            if 'already exists' not in str(e).lower():
+                # Plain Redis without the search module
+                self.semantic_enabled = False
+                return False
+
+        self._index_ready = True
+        return True
@@ -1,89 +1,782 @@
 import os
-import base64
-from typing import Dict, Any, Optional
-from openai import OpenAI
-from dotenv import load_dotenv
+import uuid
+import asyncio
+import hashlib
+import ijson
+import orjson
+import msgspec
+import httpx
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Dict, Any, Optional, AsyncIterator, List, Union
+from openai import AsyncOpenAI, APIError
+from services.redis_client import get_redis
+from services.llm_cache import LLMResponseCache
+from services.image_processing import prepare_data_url, b64encode_as_string
 
-# Load environment variables
-load_dotenv()
+# Read once; .env is loaded by main.py before this module is imported
+_API_KEY = os.getenv('OPENAI_API_KEY')
+
+# Completion requests in flight at once per worker, to stay under the
+# account's rate limits when many diagnoses or chats arrive together
+OPENAI_CONCURRENCY = int(os.getenv('OPENAI_CONCURRENCY', 32))
+
+# Model configurations for different use cases (read-only, shared by all clients)
+_MODELS = MappingProxyType({
+    'diagnosis': MappingProxyType({
+        'vision_model': 'gpt-4o-mini',  # Most affordable vision model
+        'fallback_model': 'gpt-3.5-turbo'  # Fallback for text-only
+    }),
+    'chat': MappingProxyType({
+        'primary_model': 'gpt-3.5-turbo',  # Most affordable for chat
+        'fallback_model': 'gpt-4o-mini'  # Fallback if needed
+    }),
+    'summary': MappingProxyType({
+        'primary_model': 'gpt-4o-mini'  # Cheap model for condensing old turns
+    })
+})
+
+# Messages returned in the /chat conversation history
+MAX_CHAT_HISTORY = 10
+
+# Prompt tokens of conversation history sent with each chat request; the
+# oldest messages are dropped first
+CHAT_HISTORY_TOKEN_BUDGET = int(os.getenv('CHAT_HISTORY_TOKEN_BUDGET', 3000))
+
+# Tokens each message costs beyond its content (role and framing)
+_MESSAGE_OVERHEAD_TOKENS = 4
+
+# Seconds startup waits for the tokenizers to load (which may mean a
+# download) before serving with estimated token counts
+TOKENIZER_LOAD_TIMEOUT = 10
+
+# Seconds a diagnosis may run before a duplicate request is raced against
+# it, cutting tail latency when one upstream request stalls (0 disables)
+DIAGNOSIS_HEDGE_DELAY = float(os.getenv('DIAGNOSIS_HEDGE_DELAY', 8))
+
+# Total size of the encoded images kept in memory, so retries and repeat
+# diagnoses of the same upload skip base64 encoding. Bounded by bytes, not
+# entries: images that can't be downscaled are cached at full size (a
+# data URL is ~1.3x the image), and any over a quarter of the budget
+# isn't cached at all
+IMAGE_CACHE_BYTES = 32 * 1024 * 1024
+
+# Images at least this large are downscaled and encoded in a worker
+# process, off the event loop and in parallel across cores; smaller ones
+# are cheaper to handle inline than to send to another process
+PROCESS_POOL_THRESHOLD = 256 * 1024
+
+# Image preparation processes per server worker (started on demand). Every
+# gunicorn worker has its own pool, so by default they split the CPUs
+# between them rather than each spawning one process per core
+IMAGE_POOL_WORKERS = int(os.getenv(
+    'IMAGE_POOL_WORKERS', max(1, (os.cpu_count() or 1) // int(os.getenv('WEB_CONCURRENCY', 1)))
+))
+
+# Vision detail level ('low', 'high' or 'auto'); 'low' bills a flat 85 tokens
+IMAGE_DETAIL = os.getenv('IMAGE_DETAIL', 'auto')
+
+# Output token budget for one multi-image diagnosis request
+BULK_MAX_TOKENS = 4000
+
+# A typical single diagnosis, used to estimate output tokens per image
+_SAMPLE_DIAGNOSIS = orjson.dumps({
+    'id': 'i00',
+    'name': 'Tomato',
+    'status': 'diseased',
+    'confidence': 85,
+    'problem': 'Brown spots with yellow rings are spreading across the lower leaves',
+    'cause': 'Early blight, a fungal infection that thrives in warm, wet conditions',
+    'treatment': 'Remove the affected leaves, avoid overhead watering, and spray with a copper-based fungicide every 7-10 days',
+    'prevention': 'Water at the base in the morning, space plants for airflow, and rotate crops each season'
+}).decode('utf-8')
+
+class Diagnosis(msgspec.Struct):
+    """Schema of a single diagnosis, validated while it is decoded."""
+    name: str
+    status: str
+    confidence: Union[int, float]
+    problem: str
+    cause: str
+    treatment: str
+    prevention: str
+
+_DIAGNOSIS_DECODER = msgspec.json.Decoder(Diagnosis)
+
+def _as_diagnosis(diagnosis_data: Any) -> Optional[Dict[str, Any]]:
+    """Validate already-parsed JSON against Diagnosis; return it as a dict, or None if invalid."""
+    try:
+        return msgspec.structs.asdict(msgspec.convert(diagnosis_data, Diagnosis))
+    except msgspec.ValidationError:
+        return None
+
+# Structured output schema for one diagnosis. With strict mode the API
+# only returns JSON matching it, so no scraping of prose is needed.
+_DIAGNOSIS_PROPERTIES = {
+    'name': {'type': 'string'},
+    'status': {
+        'type': 'string',
+        'enum': ['healthy', 'unhealthy', 'diseased', 'pest_infested', 'nutrient_deficient', 'stressed', 'unknown']
+    },
+    'confidence': {'type': 'integer', 'description': 'Confidence percentage from 0 to 100'},
+    'problem': {'type': 'string'},
+    'cause': {'type': 'string'},
+    'treatment': {'type': 'string'},
+    'prevention': {'type': 'string'}
+}
+
+_DIAGNOSIS_RESPONSE_FORMAT = {
+    'type': 'json_schema',
+    'json_schema': {
+        'name': 'diagnosis',
+        'strict': True,
+        'schema': {
+            'type': 'object',
+            'properties': _DIAGNOSIS_PROPERTIES,
+            'required': list(_DIAGNOSIS_PROPERTIES),
+            'additionalProperties': False
+        }
+    }
+}
+
+# Bulk requests return {"diagnoses": [...]}, one entry per image id
+_BULK_DIAGNOSIS_RESPONSE_FORMAT = {
+    'type': 'json_schema',
+    'json_schema': {
+        'name': 'bulk_diagnosis',
+        'strict': True,
+        'schema': {
+            'type': 'object',
+            'properties': {
+                'diagnoses': {
+                    'type': 'array',
+                    'items': {
+                        'type': 'object',
+                        'properties': {'id': {'type': 'string'}, **_DIAGNOSIS_PROPERTIES},
+                        'required': ['id', *_DIAGNOSIS_PROPERTIES],
+                        'additionalProperties': False
+                    }
+                }
+            },
+            'required': ['diagnoses'],
+            'additionalProperties': False
+        }
+    }
+}
+
+# tiktoken encodings by model. Only filled by _load_token_encoders, off the
+# event loop: the first load downloads the BPE file with a blocking request
+_token_encoders: Dict[str, Any] = {}
+
+def _load_token_encoders() -> None:
+    """Load the tiktoken encodings for the chat and vision models (blocking)."""
+    for model in (_MODELS['chat']['primary_model'], _MODELS['diagnosis']['vision_model']):
+        if model in _token_encoders:
+            continue
+        try:
+            import tiktoken
+            _token_encoders[model] = tiktoken.encoding_for_model(model)
+        except Exception:
+            # tiktoken missing or its encoding file can't be downloaded
+            pass
+
+async def load_token_encoders() -> None:
+    """Load the tokenizers in a thread at startup; token counts are estimated until they're ready."""
+    try:
+        await asyncio.wait_for(asyncio.to_thread(_load_token_encoders), TOKENIZER_LOAD_TIMEOUT)
+    except asyncio.TimeoutError:
+        # The thread keeps going and the encoders are picked up when it ends
+        pass
+
+@lru_cache(maxsize=4096)
+def _encoded_length(text: str, model: str) -> int:
+    return len(_token_encoders[model].encode(text))
+
+def _count_tokens(content, model: str) -> int:
+    """Count the tokens in message content; text is cached, so each message is tokenized once."""
+    if content is None:
+        return 0
+    if not isinstance(content, str):
+        # A list of content parts: estimate from its serialized size
+        return len(orjson.dumps(content)) // 4 + 1
+    if model not in _token_encoders:
+        return len(content) // 4 + 1  # ~4 characters per token
+    return _encoded_length(content, model)
+
+def _bulk_items_per_request(model: str) -> int:
+    """Return how many images fit in one bulk request without truncating the answers."""
+    # Leave headroom for answers twice as long as the sample
+    return max(1, BULK_MAX_TOKENS // (_count_tokens(_SAMPLE_DIAGNOSIS, model) * 2))
+
+# Fixed part of the diagnosis prompt. Built once and kept byte-identical
+# at the start of every request, so OpenAI's prompt caching can apply
+_BASE_DIAGNOSIS_PROMPT = """
+        You are a friendly plant health expert. Look carefully at this plant image and give a clear, easy-to-understand diagnosis.
+
+IMPORTANT: Reply with ONLY a valid JSON object in this exact format:
+{
+    "name": "Common name of the plant or crop (e.g., 'Tomato', 'Rose', 'Unknown')",
+    "status": "healthy|unhealthy|diseased|pest_infested|nutrient_deficient|stressed",
+    "confidence": 85,
+    "problem": "Describe what you actually see happening (e.g., 'Leaves turning yellow at the bottom', 'Brown spots spreading on leaves', 'Wilting stems', 'Looks healthy overall')",
+    "cause": "Explain in simple terms what’s causing it (e.g., 'Fungal infection', 'Insect damage', 'Lack of nutrients', 'Too much water', 'Normal growth')",
+    "treatment": "Give easy-to-follow steps to help the plant recover (e.g., 'Remove affected leaves and spray with a mild fungicide')",
+    "prevention": "Practical tips to stop it from happening again (e.g., 'Water early in the morning and avoid wetting leaves')"
+}
+
+Guidelines:
+1. Identify the plant or crop name if possible; use "Unknown" if unsure.
+2. Judge how the plant looks — healthy, unhealthy, or showing disease, pest, or nutrient problems.
+3. Set confidence as a percentage (0–100) based on how sure you are.
+4. Describe the visible issue in plain language.
+5. Keep explanations short, clear, and easy to understand.
+6. Give practical treatment steps anyone can follow at home.
+7. Suggest simple prevention tips to keep the plant healthy.
+8. Don’t assume every plant is healthy — be honest about what you see.
+
+Focus on:
+- Simple, friendly language anyone can understand.
+- Useful, realistic advice for home gardeners.
+- Clear separation between what’s happening, why, and what to do.
+
+        """
+
+# System message that starts every chat request
+_SYSTEM_CHAT_MSG = {
+    "role": "system",
+    "content": """You are a helpful plant care assistant. You can answer questions about:
+                - Plant identification
+                - Plant care and maintenance
+                - Common plant problems and solutions
+                - Growing tips and advice
+                - Plant diseases and pests
+                
+                Be friendly, informative, and practical in your responses. If you're unsure about something, 
+                recommend consulting with a local plant expert or nursery."""
+}
+
+_openai: Optional[AsyncOpenAI] = None
+
+# Caps completion requests across every OpenAIClient in the process
+_request_slots = asyncio.Semaphore(OPENAI_CONCURRENCY)
+
+def _get_openai() -> AsyncOpenAI:
+    """Return the process-wide AsyncOpenAI client, creating it on first use."""
+    global _openai
+    
+    if _openai is None:
+        # One keep-alive HTTP/2 pool for every chat, diagnosis and embedding
+        # call, so requests reuse warm TLS connections to the API
+        http = httpx.AsyncClient(
+            http2=True,
+            timeout=httpx.Timeout(60.0, connect=5.0),
+            limits=httpx.Limits(
+                max_keepalive_connections=100,
+                max_connections=200,
+                # httpx drops idle connections after 5s by default, which
+                # means a fresh TLS handshake after every lull in traffic
+                keepalive_expiry=60.0
+            )
+        )
+        # The SDK retries connection errors, 429s and 5xx with jittered backoff
+        _openai = AsyncOpenAI(
+            api_key=_API_KEY,
+            http_client=http,
+            max_retries=3,
+            timeout=30.0
+        )
+    
+    return _openai
+
+_image_pool: Optional[ProcessPoolExecutor] = None
+
+def _get_image_pool() -> ProcessPoolExecutor:
+    """Return the process pool for image preparation, starting it on first use."""
+    global _image_pool
+    
+    if _image_pool is None:
+        # Spawn rather than fork: forking a process that is running an event
+        # loop and SDK threads can deadlock the child
+        _image_pool = ProcessPoolExecutor(
+            max_workers=IMAGE_POOL_WORKERS,
+            mp_context=multiprocessing.get_context('spawn')
+        )
+    
+    return _image_pool
+
+def _close_image_pool() -> None:
+    """Shut down the image process pool without waiting on queued work."""
+    global _image_pool
+    
+    if _image_pool is not None:
+        _image_pool.shutdown(wait=False, cancel_futures=True)
+        _image_pool = None
+
+async def _close_openai() -> None:
+    """Close the shared AsyncOpenAI client and its HTTP pool."""
+    global _openai
+    
+    if _openai is not None:
+        # AsyncOpenAI.close() closes the injected httpx client as well
+        await _openai.close()
+        _openai = None
 
 class OpenAIClient:
+    # Fixed diagnosis request parameters, merged into every request payload
+    _DIAGNOSIS_TEMPLATE = {
+        'response_format': _DIAGNOSIS_RESPONSE_FORMAT,
+        'max_tokens': 1000,
+        'temperature': 0.3  # Lower temperature for more consistent medical advice
+    }
+    
     def __init__(self):
         """Initialize OpenAI client with API key from environment variables."""
-        self.client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+        # Shared by every OpenAIClient, so all of them reuse one warm pool
+        self.client = _get_openai()
+        self.request_slots = _request_slots
         
-        # Model configurations for different use cases
-        self.models = {
-            'diagnosis': {
-                'vision_model': 'gpt-4o-mini',  # Most affordable vision model
-                'fallback_model': 'gpt-3.5-turbo'  # Fallback for text-only
-            },
-            'chat': {
-                'primary_model': 'gpt-3.5-turbo',  # Most affordable for chat
-                'fallback_model': 'gpt-4o-mini'  # Fallback if needed
-            }
-        }
+        # Recently encoded image data URLs, least recently used first
+        self._data_urls = OrderedDict()
+        self._data_url_bytes = 0
+        
+        # Read-only view of the shared model configuration
+        self.models = _MODELS
+        
+        # Cache chat responses and diagnoses when Redis is available
+        redis = get_redis()
+        self.response_cache = LLMResponseCache(redis, self.client) if redis is not None else None
     
-    def encode_image_to_base64(self, image_path: str) -> str:
-        """Encode image file to base64 string for OpenAI API."""
-        try:
-            with open(image_path, "rb") as image_file:
-                return base64.b64encode(image_file.read()).decode('utf-8')
-        except Exception as e:
-            raise Exception(f"Error encoding image: {str(e)}")
+    async def aclose(self) -> None:
+        """Close the shared HTTP connection pool and image worker processes."""
+        _close_image_pool()
+        await _close_openai()
+    
+    def encode_image_to_base64(self, image_bytes: bytes) -> str:
+        """Encode image bytes to base64 string for OpenAI API."""
+        return b64encode_as_string(image_bytes)
     
-    def diagnose_plant(self, image_path: str, additional_info: Optional[str] = None, user_label: Optional[str] = None) -> Dict[str, Any]:
+    async def _image_data_url(self, image_bytes: bytes, mime_type: str = 'image/jpeg') -> str:
+        """Return the (downscaled) base64 data URL for an image, reusing recent encodings."""
+        key = (hashlib.blake2b(image_bytes, digest_size=16).digest(), mime_type)
+        
+        data_url = self._data_urls.get(key)
+        if data_url is not None:
+            self._data_urls.move_to_end(key)
+            return data_url
+        
+        if len(image_bytes) < PROCESS_POOL_THRESHOLD:
+            data_url = prepare_data_url(image_bytes, mime_type)
+        else:
+            try:
+                loop = asyncio.get_running_loop()
+                data_url = await loop.run_in_executor(_get_image_pool(), prepare_data_url, image_bytes, mime_type)
+            except BrokenProcessPool:
+                # A worker died (e.g. OOM-killed); start a fresh pool next time
+                _close_image_pool()
+                data_url = prepare_data_url(image_bytes, mime_type)
+        
+        # Skip entries too big to share the cache, and ones a concurrent
+        # request for the same image stored while this one was encoding
+        if len(data_url) > IMAGE_CACHE_BYTES // 4 or key in self._data_urls:
+            return data_url
+        
+        self._data_urls[key] = data_url
+        self._data_url_bytes += len(data_url)
+        while self._data_url_bytes > IMAGE_CACHE_BYTES:
+            _, evicted = self._data_urls.popitem(last=False)
+            self._data_url_bytes -= len(evicted)
+        
+        return data_url
+    
+    async def diagnose_plant(self, image_bytes: bytes, mime_type: str = 'image/jpeg', additional_info: Optional[str] = None, user_label: Optional[str] = None) -> Dict[str, Any]:
         """
         Diagnose plant health from image using OpenAI vision model.
         
         Args:
-            image_path: Path to the plant image
+            image_bytes: Raw bytes of the plant image
+            mime_type: MIME type of the image (e.g. 'image/png')
             additional_info: Optional additional context about the plant
             user_label: Optional user-provided plant/crop label
             
         Returns:
             Dictionary containing plant name, status, confidence, cause, treatment, and prevention
         """
+        # Reuse the diagnosis of an identical upload (retries, duplicate clients)
+        if self.response_cache:
+            cached_result = await self.response_cache.get_diagnosis(image_bytes, additional_info, user_label)
+            if cached_result is not None:
+                return cached_result
+        
         try:
-            # Encode image to base64
-            base64_image = self.encode_image_to_base64(image_path)
-            
-            # Prepare the prompt for plant diagnosis
-            prompt = self._get_diagnosis_prompt(additional_info, user_label)
+            request_params = await self._build_diagnosis_request(image_bytes, mime_type, additional_info, user_label)
             
             # Make API call to OpenAI
-            response = self.client.chat.completions.create(
-                model=self.models['diagnosis']['vision_model'],
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": prompt
-                            },
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{base64_image}"
-                                }
-                            }
-                        ]
-                    }
-                ],
-                max_tokens=1000,
-                temperature=0.3  # Lower temperature for more consistent medical advice
-            )
+            diagnosis_text = await self._hedged_completion(request_params)
             
             # Parse and structure the response
-            diagnosis_text = response.choices[0].message.content
-            return self._parse_diagnosis_response(diagnosis_text)
+            diagnosis_result = self._parse_diagnosis_response(diagnosis_text)
             
-        except Exception as e:
+            # Only cache clean parses so unclear answers get another try
+            if self.response_cache and diagnosis_result.get('success') and 'parsing_warning' not in diagnosis_result:
+                await self.response_cache.store_diagnosis(image_bytes, additional_info, user_label, diagnosis_result)
+            
+            return diagnosis_result
+            
+        except APIError as e:
             # Fallback to text-only model if vision model fails
-            return self._fallback_diagnosis(str(e), additional_info, user_label)
+            return await self._fallback_diagnosis(str(e), additional_info, user_label)
+    
+    async def _complete(self, request_params: Dict[str, Any]) -> str:
+        """Run one chat completion and return its text."""
+        async with self.request_slots:
+            response = await self.client.chat.completions.create(**request_params)
+        return response.choices[0].message.content
+    
+    async def _hedged_completion(self, request_params: Dict[str, Any]) -> str:
+        """
+        Run a completion, racing a duplicate request if it is slow.
+        
+        Returns the first successful answer and cancels the other request.
+        Raises the last error only if every request failed.
+        """
+        tasks = [asyncio.create_task(self._complete(request_params))]
+        try:
+            if DIAGNOSIS_HEDGE_DELAY > 0:
+                done, _ = await asyncio.wait(tasks, timeout=DIAGNOSIS_HEDGE_DELAY)
+                if not done:
+                    tasks.append(asyncio.create_task(self._complete(request_params)))
+            
+            error = None
+            for next_done in asyncio.as_completed(tasks):
+                try:
+                    return await next_done
+                except APIError as e:
+                    error = e
+            raise error
+            
+        finally:
+            for task in tasks:
+                task.cancel()
     
-    def chat_with_ai(self, user_message: str, conversation_history: Optional[list] = None) -> Dict[str, Any]:
+    async def diagnose_plant_stream(self, image_bytes: bytes, mime_type: str = 'image/jpeg', additional_info: Optional[str] = None, user_label: Optional[str] = None) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Stream a diagnosis, pushing each field as soon as the model has written it.
+        
+        Args:
+            Same as diagnose_plant
+            
+        Yields:
+            {'field': name, 'value': value} for each top-level field of the
+            diagnosis as it completes, then a final event with 'done': True and
+            the full diagnose_plant result, which is authoritative if the
+            streamed fields could not be used
+        """
+        if self.response_cache:
+            cached_result = await self.response_cache.get_diagnosis(image_bytes, additional_info, user_label)
+            if cached_result is not None:
+                for field, value in cached_result.get('data', {}).items():
+                    yield {'field': field, 'value': value}
+                yield {'done': True, **cached_result}
+                return
+        
+        try:
+            request_params = await self._build_diagnosis_request(image_bytes, mime_type, additional_info, user_label)
+            
+            # Push parser: completed top-level key/value pairs collect in fields
+            fields = ijson.sendable_list()
+            parser = ijson.kvitems_coro(fields, '', use_float=True)
+            object_started = False
+            response_parts = []
+            
+            async with self.request_slots:
+                stream = await self.client.chat.completions.create(**request_params, stream=True)
+                try:
+                    async for chunk in stream:
+                        if not (chunk.choices and chunk.choices[0].delta.content):
+                            continue
+                        
+                        text = chunk.choices[0].delta.content
+                        response_parts.append(text)
+                        if parser is None:
+                            continue
+                        
+                        if not object_started:
+                            # Skip any preamble, such as a code fence, before the object
+                            brace = text.find('{')
+                            if brace < 0:
+                                continue
+                            text = text[brace:]
+                            object_started = True
+                        
+                        try:
+                            parser.send(text.encode('utf-8'))
+                        except ijson.JSONError:
+                            # Trailing text after the object; the full parse below still runs
+                            parser = None
+                        
+                        for field, value in fields:
+                            yield {'field': field, 'value': value}
+                        del fields[:]
+                finally:
+                    await stream.close()
+            
+            diagnosis_result = self._parse_diagnosis_response(''.join(response_parts))
+            
+            # Only cache clean parses so unclear answers get another try
+            if self.response_cache and diagnosis_result.get('success') and 'parsing_warning' not in diagnosis_result:
+                await self.response_cache.store_diagnosis(image_bytes, additional_info, user_label, diagnosis_result)
+                
+        except APIError as e:
+            # Fallback to text-only model if vision model fails
+            diagnosis_result = await self._fallback_diagnosis(str(e), additional_info, user_label)
+        
+        yield {'done': True, **diagnosis_result}
+    
+    async def _build_diagnosis_request(self, image_bytes: bytes, mime_type: str = 'image/jpeg', additional_info: Optional[str] = None, user_label: Optional[str] = None) -> Dict[str, Any]:
+        """Build the chat completion parameters for a diagnosis (shared by direct and batch calls)."""
+        # Only the prompt and image change per request
+        return {
+            **self._DIAGNOSIS_TEMPLATE,
+            'model': _MODELS['diagnosis']['vision_model'],
+            'messages': [{
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": self._get_diagnosis_prompt(additional_info, user_label)},
+                    {"type": "image_url", "image_url": {"url": await self._image_data_url(image_bytes, mime_type), "detail": IMAGE_DETAIL}}
+                ]
+            }]
+        }
+    
+    async def diagnose_many(self, items: List[Dict[str, Any]]) -> List[Union[Dict[str, Any], BaseException]]:
+        """
+        Diagnose several plant images concurrently.
+        
+        Args:
+            items: Keyword arguments for diagnose_plant, one dict per image
+            
+        Returns:
+            Results in the same order as items; an item that raised returns
+            its exception instead of failing the whole batch
+        """
+        return await asyncio.gather(
+            *(self.diagnose_plant(**item) for item in items),
+            return_exceptions=True
+        )
+    
+    async def diagnose_plants_bulk(self, items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Diagnose several plant images with as few requests as possible.
+        
+        Images are packed into shared requests (sized so the answers fit the
+        output token budget), which saves requests when the per-minute request
+        limit is the bottleneck and sends the long prompt once per group.
+        
+        Args:
+            items: Keyword arguments for diagnose_plant, one dict per image
+            
+        Returns:
+            Diagnosis results in the same order as items
+        """
+        group_size = _bulk_items_per_request(_MODELS['diagnosis']['vision_model'])
+        groups = [items[start:start + group_size] for start in range(0, len(items), group_size)]
+        
+        group_results = await asyncio.gather(*(self._diagnose_group(group) for group in groups))
+        return [result for results in group_results for result in results]
+    
+    async def _diagnose_group(self, items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Diagnose a group of images in one request; images the answer misses are retried singly."""
+        item_ids = [f"i{index}" for index in range(len(items))]
+        
+        diagnoses = {}
+        try:
+            content = [{"type": "text", "text": self._get_bulk_diagnosis_prompt(item_ids)}]
+            for item_id, item in zip(item_ids, items):
+                caption = f"Image {item_id}"
+                if item.get('user_label'):
+                    caption += f" - user-provided plant label: {item['user_label']}"
+                if item.get('additional_info'):
+                    caption += f" - additional context provided by user: {item['additional_info']}"
+                
+                content.append({"type": "text", "text": caption})
+                content.append({
+                    "type": "image_url",
+                    "image_url": {
+                        "url": await self._image_data_url(item['image_bytes'], item.get('mime_type', 'image/jpeg')),
+                        "detail": IMAGE_DETAIL
+                    }
+                })
+            
+            async with self.request_slots:
+                response = await self.client.chat.completions.create(
+                    model=_MODELS['diagnosis']['vision_model'],
+                    messages=[{"role": "user", "content": content}],
+                    response_format=_BULK_DIAGNOSIS_RESPONSE_FORMAT,
+                    max_tokens=BULK_MAX_TOKENS,
+                    temperature=0.3
+                )
+            
+            diagnosis_result = self._parse_diagnosis_response(response.choices[0].message.content)
+            diagnoses = diagnosis_result.get('diagnoses') or {}
+            
+        except APIError:
+            pass
+        
+        # Anything missing from the combined answer gets its own request
+        missing = [index for index, item_id in enumerate(item_ids) if item_id not in diagnoses]
+        retried = await asyncio.gather(*(self.diagnose_plant(**items[index]) for index in missing))
+        diagnoses.update((item_ids[index], result) for index, result in zip(missing, retried))
+        
+        return [diagnoses[item_id] for item_id in item_ids]
+    
+    async def submit_batch_diagnoses(self, items: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Queue diagnoses on the OpenAI Batch API for non-interactive bulk work.
+        
+        Batches cost half as much as direct calls and draw on a separate rate
+        limit pool, but complete within 24 hours rather than seconds.
+        
+        Args:
+            items: Keyword arguments for diagnose_plant, one dict per image;
+                   an optional 'custom_id' identifies the item in the results
+            
+        Returns:
+            Dictionary with the batch_id and the custom_ids in submission order
+        """
+        try:
+            lines = []
+            custom_ids = []
+            for item in items:
+                item = dict(item)
+                custom_id = item.pop('custom_id', None) or uuid.uuid4().hex
+                custom_ids.append(custom_id)
+                lines.append(orjson.dumps({
+                    'custom_id': custom_id,
+                    'method': 'POST',
+                    'url': '/v1/chat/completions',
+                    'body': await self._build_diagnosis_request(**item)
+                }))
+            
+            batch_file = await self.client.files.create(
+                file=('diagnoses.jsonl', b'\n'.join(lines)),
+                purpose='batch'
+            )
+            batch = await self.client.batches.create(
+                input_file_id=batch_file.id,
+                endpoint='/v1/chat/completions',
+                completion_window='24h'
+            )
+            
+            return {
+                'success': True,
+                'batch_id': batch.id,
+                'status': batch.status,
+                'custom_ids': custom_ids
+            }
+            
+        except APIError as e:
+            return {
+                'success': False,
+                'error': f"Batch submission failed: {str(e)}"
+            }
+    
+    async def retrieve_batch(self, batch_id: str) -> Dict[str, Any]:
+        """Return the status and request counts of a submitted batch."""
+        try:
+            batch = await self.client.batches.retrieve(batch_id)
+            return {
+                'success': True,
+                'batch_id': batch.id,
+                'status': batch.status,
+                'request_counts': batch.request_counts.model_dump() if batch.request_counts else None,
+                'output_file_id': batch.output_file_id,
+                'error_file_id': batch.error_file_id
+            }
+            
+        except APIError as e:
+            return {
+                'success': False,
+                'batch_id': batch_id,
+                'error': f"Batch retrieval failed: {str(e)}"
+            }
+    
+    async def wait_for_batch(self, batch_id: str, poll_interval: float = 30.0, timeout: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Wait for a batch to finish and parse its diagnoses.
+        
+        Args:
+            batch_id: ID returned by submit_batch_diagnoses
+            poll_interval: Seconds between status checks
+            timeout: Optional maximum seconds to wait (raises asyncio.TimeoutError)
+            
+        Returns:
+            Dictionary with the batch_id, its final status, and 'results':
+            diagnosis results keyed by custom_id, in the same shape as
+            diagnose_plant (failed requests map to an error result). 'success'
+            is False, with an 'error', if the batch did not complete or the
+            API could not be reached.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout if timeout is not None else None
+        
+        while True:
+            batch = await self.retrieve_batch(batch_id)
+            if not batch['success']:
+                return batch
+            if batch['status'] in ('completed', 'failed', 'expired', 'cancelled'):
+                break
+            if deadline is not None and loop.time() >= deadline:
+                raise asyncio.TimeoutError(f"Batch {batch_id} still {batch['status']} after {timeout}s")
+            await asyncio.sleep(poll_interval)
+        
+        results = {}
+        try:
+            for file_id in (batch['output_file_id'], batch['error_file_id']):
+                if not file_id:
+                    continue
+                
+                content = await self.client.files.content(file_id)
+                for line in content.text.splitlines():
+                    if not line.strip():
+                        continue
+                    
+                    record = orjson.loads(line)
+                    response = record.get('response') or {}
+                    if response.get('status_code') == 200:
+                        diagnosis_text = response['body']['choices'][0]['message']['content']
+                        results[record['custom_id']] = self._parse_diagnosis_response(diagnosis_text)
+                    else:
+                        error = record.get('error') or response.get('body', {}).get('error') or {}
+                        results[record['custom_id']] = {
+                            'success': False,
+                            'error': f"Batch diagnosis failed: {error.get('message', batch['status'])}"
+                        }
+                        
+        except APIError as e:
+            return {
+                'success': False,
+                'batch_id': batch_id,
+                'status': batch['status'],
+                'results': results,
+                'error': f"Batch results download failed: {str(e)}"
+            }
+        
+        result = {
+            'success': batch['status'] == 'completed',
+            'batch_id': batch_id,
+            'status': batch['status'],
+            'results': results
+        }
+        if not result['success']:
+            # Failed, expired or cancelled; results holds whatever finished
+            result['error'] = f"Batch {batch['status']}"
+        
+        return result
+    
+    async def chat_with_ai(self, user_message: str, conversation_history: Optional[list] = None) -> Dict[str, Any]:
         """
         Handle chat conversations with users about plants.
         
@@ -95,148 +788,256 @@ class OpenAIClient:
             Dictionary containing AI response and updated conversation history
         """
         try:
-            # Prepare messages for chat
-            messages = self._prepare_chat_messages(user_message, conversation_history)
+            # Serve repeated or paraphrased questions from the cache
+            ai_response, query_embedding = None, None
+            if self.response_cache:
+                ai_response, query_embedding = await self.response_cache.lookup(user_message, conversation_history)
             
-            # Make API call to OpenAI
-            response = self.client.chat.completions.create(
-                model=self.models['chat']['primary_model'],
-                messages=messages,
-                max_tokens=500,
-                temperature=0.7  # Higher temperature for more conversational responses
-            )
-            
-            ai_response = response.choices[0].message.content
+            if ai_response is None:
+                # Prepare messages for chat
+                messages = self._prepare_chat_messages(user_message, conversation_history)
+                
+                # Make API call to OpenAI
+                async with self.request_slots:
+                    response = await self.client.chat.completions.create(
+                        model=_MODELS['chat']['primary_model'],
+                        messages=messages,
+                        max_tokens=500,
+                        temperature=0.7  # Higher temperature for more conversational responses
+                    )
+                
+                ai_response = response.choices[0].message.content
+                
+                # An empty reply would be served to every matching request
+                if self.response_cache and ai_response:
+                    await self.response_cache.store(user_message, conversation_history, ai_response, query_embedding)
             
-            # Update conversation history
+            # Update conversation history (a bounded copy, so the caller's list is untouched)
             updated_history = self._update_conversation_history(
-                conversation_history or [], user_message, ai_response
+                deque(conversation_history or (), maxlen=MAX_CHAT_HISTORY), user_message, ai_response
             )
             
             return {
                 'success': True,
                 'response': ai_response,
-                'conversation_history': updated_history,
-                'model_used': self.models['chat']['primary_model']
+                'conversation_history': list(updated_history),
+                'model_used': _MODELS['chat']['primary_model']
             }
             
-        except Exception as e:
+        except APIError as e:
             return {
                 'success': False,
                 'error': f"Chat error: {str(e)}",
                 'response': "I'm sorry, I'm having trouble responding right now. Please try again later."
             }
     
-    def _get_diagnosis_prompt(self, additional_info: Optional[str] = None, user_label: Optional[str] = None) -> str:
-        """Generate the prompt for plant diagnosis."""
-        base_prompt = """
-        You are a friendly plant health expert. Look carefully at this plant image and give a clear, easy-to-understand diagnosis.
-
-IMPORTANT: Reply with ONLY a valid JSON object in this exact format:
-{
-    "name": "Common name of the plant or crop (e.g., 'Tomato', 'Rose', 'Unknown')",
-    "status": "healthy|unhealthy|diseased|pest_infested|nutrient_deficient|stressed",
-    "confidence": 85,
-    "problem": "Describe what you actually see happening (e.g., 'Leaves turning yellow at the bottom', 'Brown spots spreading on leaves', 'Wilting stems', 'Looks healthy overall')",
-    "cause": "Explain in simple terms what’s causing it (e.g., 'Fungal infection', 'Insect damage', 'Lack of nutrients', 'Too much water', 'Normal growth')",
-    "treatment": "Give easy-to-follow steps to help the plant recover (e.g., 'Remove affected leaves and spray with a mild fungicide')",
-    "prevention": "Practical tips to stop it from happening again (e.g., 'Water early in the morning and avoid wetting leaves')"
-}
-
-Guidelines:
-1. Identify the plant or crop name if possible; use "Unknown" if unsure.
-2. Judge how the plant looks — healthy, unhealthy, or showing disease, pest, or nutrient problems.
-3. Set confidence as a percentage (0–100) based on how sure you are.
-4. Describe the visible issue in plain language.
-5. Keep explanations short, clear, and easy to understand.
-6. Give practical treatment steps anyone can follow at home.
-7. Suggest simple prevention tips to keep the plant healthy.
-8. Don’t assume every plant is healthy — be honest about what you see.
-
-Focus on:
-- Simple, friendly language anyone can understand.
-- Useful, realistic advice for home gardeners.
-- Clear separation between what’s happening, why, and what to do.
-
+    async def stream_chat(self, user_message: str, conversation_history: Optional[list] = None) -> AsyncIterator[str]:
         """
+        Stream a chat response as it is generated.
         
-        if user_label:
-            base_prompt += f"\n\nUser-provided plant label: {user_label}"
+        Args:
+            user_message: User's question or message
+            conversation_history: Optional list of previous messages
+            
+        Yields:
+            Pieces of the AI response text, in order. A cached response is
+            yielded whole. Errors propagate to the caller.
+        """
+        query_embedding = None
+        if self.response_cache:
+            cached_response, query_embedding = await self.response_cache.lookup(user_message, conversation_history)
+            if cached_response is not None:
+                yield cached_response
+                return
         
-        if additional_info:
-            base_prompt += f"\n\nAdditional context provided by user: {additional_info}"
+        messages = self._prepare_chat_messages(user_message, conversation_history)
+        response_parts = []
         
-        base_prompt += "\n\nRespond with ONLY the JSON object, no additional text."
+        # The slot is held until the stream ends, like any other completion
+        async with self.request_slots:
+            stream = await self.client.chat.completions.create(
+                model=_MODELS['chat']['primary_model'],
+                messages=messages,
+                max_tokens=500,
+                temperature=0.7,
+                stream=True
+            )
+            
+            try:
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        response_parts.append(chunk.choices[0].delta.content)
+                        yield chunk.choices[0].delta.content
+            finally:
+                # Also runs when the client disconnects, so generation stops
+                # instead of spending tokens nobody will read
+                await stream.close()
         
-        return base_prompt
+        ai_response = ''.join(response_parts)
+        # Don't cache a stream that produced no text
+        if self.response_cache and ai_response:
+            await self.response_cache.store(user_message, conversation_history, ai_response, query_embedding)
     
-    def _parse_diagnosis_response(self, response_text: str) -> Dict[str, Any]:
-        """Parse the diagnosis response from OpenAI."""
+    async def chat_with_ai_stream(self, user_message: str, conversation_history: Optional[list] = None) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Streaming counterpart of chat_with_ai.
+        
+        Args:
+            user_message: User's question or message
+            conversation_history: Optional list of previous messages
+            
+        Yields:
+            {'delta': text} for each piece of the AI response, then a final
+            event with 'done': True and the rest of chat_with_ai's result
+        """
+        response_parts = []
         try:
-            import json
-            import re
+            async for delta in self.stream_chat(user_message, conversation_history):
+                response_parts.append(delta)
+                yield {'delta': delta}
+                
+        except APIError as e:
+            yield {
+                'done': True,
+                'success': False,
+                'error': f"Chat error: {str(e)}",
+                'response': "I'm sorry, I'm having trouble responding right now. Please try again later."
+            }
+            return
+        
+        updated_history = self._update_conversation_history(
+            deque(conversation_history or (), maxlen=MAX_CHAT_HISTORY), user_message, ''.join(response_parts)
+        )
+        
+        yield {
+            'done': True,
+            'success': True,
+            'conversation_history': list(updated_history),
+            'model_used': _MODELS['chat']['primary_model']
+        }
+    
+    async def summarize_conversation(self, messages: list, previous_summary: Optional[str] = None) -> Optional[str]:
+        """
+        Condense older conversation turns into a short summary.
+        
+        Args:
+            messages: Messages to summarize, oldest first
+            previous_summary: Optional summary of turns before these messages
             
-            # Clean the response text
-            cleaned_text = response_text.strip()
+        Returns:
+            Summary text, or None if summarization failed
+        """
+        try:
+            transcript = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+            prompt = (
+                "Summarize this plant care conversation in a few sentences. Keep the plants, "
+                "symptoms, and advice already given so the assistant can continue it.\n\n"
+            )
+            if previous_summary:
+                prompt += f"Summary of earlier turns: {previous_summary}\n\n"
+            prompt += f"Conversation:\n{transcript}"
             
-            # Try to parse as direct JSON first
-            try:
-                diagnosis_data = json.loads(cleaned_text)
-                # Validate required fields
-                required_fields = ['name', 'status', 'confidence', 'problem', 'cause', 'treatment', 'prevention']
-                if all(field in diagnosis_data for field in required_fields):
-                    # Validate confidence is a number
-                    if isinstance(diagnosis_data.get('confidence'), (int, float)):
-                        return {
-                            'success': True,
-                            'data': diagnosis_data,
-                            'raw_response': response_text
-                        }
-            except json.JSONDecodeError:
-                pass
+            async with self.request_slots:
+                response = await self.client.chat.completions.create(
+                    model=_MODELS['summary']['primary_model'],
+                    messages=[{"role": "user", "content": prompt}],
+                    max_tokens=300,
+                    temperature=0.3
+                )
             
-            # Look for JSON in the response using regex
-            json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
-            if json_match:
-                try:
-                    diagnosis_data = json.loads(json_match.group())
-                    # Validate required fields
-                    required_fields = ['name', 'status', 'confidence', 'problem', 'cause', 'treatment', 'prevention']
-                    if all(field in diagnosis_data for field in required_fields):
-                        # Validate confidence is a number
-                        if isinstance(diagnosis_data.get('confidence'), (int, float)):
-                            return {
-                                'success': True,
-                                'data': diagnosis_data,
-                                'raw_response': response_text
-                            }
-                except json.JSONDecodeError:
-                    pass
-            
-            # If no valid JSON found, create a structured response
-            return {
-                'success': True,
-                'data': {
-                    'name': 'Unknown',
-                    'status': 'unknown',
-                    'confidence': 25,
-                    'problem': 'Unable to analyze image properly',
-                    'cause': 'Unable to parse AI response properly',
-                    'treatment': 'Please try uploading a clearer image or consult a plant expert',
-                    'prevention': 'Ensure good plant care practices and regular monitoring'
-                },
-                'raw_response': response_text,
-                'parsing_warning': 'Response was not in expected JSON format'
-            }
+            return response.choices[0].message.content
             
-        except Exception as e:
+        except APIError:
+            return None
+    
+    def _get_diagnosis_prompt(self, additional_info: Optional[str] = None, user_label: Optional[str] = None) -> str:
+        """Generate the prompt for plant diagnosis."""
+        # The fixed text leads so the API's prompt cache can reuse it
+        parts = [_BASE_DIAGNOSIS_PROMPT]
+        
+        if user_label:
+            parts.append(f"\n\nUser-provided plant label: {user_label}")
+        
+        if additional_info:
+            parts.append(f"\n\nAdditional context provided by user: {additional_info}")
+        
+        parts.append("\n\nRespond with ONLY the JSON object, no additional text.")
+        
+        return "".join(parts)
+    
+    def _get_bulk_diagnosis_prompt(self, item_ids: List[str]) -> str:
+        """Generate the prompt for diagnosing several labelled images in one request."""
+        return "".join([
+            _BASE_DIAGNOSIS_PROMPT,
+            f"\n\nYou will receive {len(item_ids)} plant images, each preceded by its id "
+            f"({', '.join(item_ids)}). Diagnose every image separately.",
+            "\n\nRespond with a JSON object whose \"diagnoses\" array holds one object in the format "
+            "above per image, in the same order, each with an extra \"id\" field set to the image's id."
+        ])
+    
+    def _parse_diagnosis_response(self, response_text: Optional[str]) -> Dict[str, Any]:
+        """Parse the diagnosis response from OpenAI (structured output, so plain JSON)."""
+        # Clean the response text (None when the model refused)
+        cleaned_text = (response_text or '').strip().encode('utf-8')
+        
+        # A single diagnosis, decoded and validated in one pass
+        try:
             return {
-                'success': False,
-                'error': f"Error parsing diagnosis response: {str(e)}",
+                'success': True,
+                'data': msgspec.structs.asdict(_DIAGNOSIS_DECODER.decode(cleaned_text)),
                 'raw_response': response_text
             }
+        except msgspec.DecodeError:
+            pass
+        
+        # Bulk requests hold one diagnosis per image
+        try:
+            diagnosis_data = orjson.loads(cleaned_text)
+        except orjson.JSONDecodeError:
+            diagnosis_data = None
+        
+        if isinstance(diagnosis_data, dict) and isinstance(diagnosis_data.get('diagnoses'), list):
+            return self._split_bulk_diagnoses(diagnosis_data['diagnoses'], response_text)
+        
+        # If no valid JSON found, create a structured response
+        return {
+            'success': True,
+            'data': {
+                'name': 'Unknown',
+                'status': 'unknown',
+                'confidence': 25,
+                'problem': 'Unable to analyze image properly',
+                'cause': 'Unable to parse AI response properly',
+                'treatment': 'Please try uploading a clearer image or consult a plant expert',
+                'prevention': 'Ensure good plant care practices and regular monitoring'
+            },
+            'raw_response': response_text,
+            'parsing_warning': 'Response was not in expected JSON format'
+        }
+    
+    def _split_bulk_diagnoses(self, entries: list, response_text: str) -> Dict[str, Any]:
+        """Split a bulk answer's diagnoses into per-image results keyed by id."""
+        diagnoses = {}
+        
+        for entry in entries:
+            if not isinstance(entry, dict) or 'id' not in entry:
+                continue
+            
+            # The extra "id" field is dropped by the Diagnosis schema
+            diagnosis = _as_diagnosis(entry)
+            if diagnosis is not None:
+                diagnoses[str(entry['id'])] = {
+                    'success': True,
+                    'data': diagnosis
+                }
+        
+        return {
+            'success': True,
+            'diagnoses': diagnoses,
+            'raw_response': response_text
+        }
     
-    def _fallback_diagnosis(self, error_message: str, additional_info: Optional[str] = None, user_label: Optional[str] = None) -> Dict[str, Any]:
+    async def _fallback_diagnosis(self, error_message: str, additional_info: Optional[str] = None, user_label: Optional[str] = None) -> Dict[str, Any]:
         """Fallback diagnosis using text-only model when vision model fails."""
         try:
             prompt = f"""
@@ -256,24 +1057,25 @@ Focus on:
             Based on the additional information provided: {additional_info or 'No additional information'}
             """
             
-            response = self.client.chat.completions.create(
-                model=self.models['diagnosis']['fallback_model'],
-                messages=[{"role": "user", "content": prompt}],
-                max_tokens=500,
-                temperature=0.3
-            )
+            async with self.request_slots:
+                response = await self.client.chat.completions.create(
+                    model=_MODELS['diagnosis']['fallback_model'],
+                    messages=[{"role": "user", "content": prompt}],
+                    max_tokens=500,
+                    temperature=0.3
+                )
             
             fallback_response = response.choices[0].message.content
             try:
-                import json
-                fallback_data = json.loads(fallback_response)
+                fallback_data = orjson.loads(fallback_response)
                 return {
                     'success': True,
                     'data': fallback_data,
                     'fallback_used': True,
                     'error': error_message
                 }
-            except:
+            except (orjson.JSONDecodeError, TypeError):
+                # Not JSON, or no content at all
                 return {
                     'success': True,
                     'data': {
@@ -288,7 +1090,7 @@ Focus on:
                     'fallback_used': True,
                     'error': error_message
                 }
-        except Exception as e:
+        except APIError as e:
             return {
                 'success': False,
                 'error': f"Fallback diagnosis failed: {str(e)}"
@@ -296,40 +1098,60 @@ Focus on:
     
     def _prepare_chat_messages(self, user_message: str, conversation_history: Optional[list] = None) -> list:
         """Prepare messages for chat API call."""
-        messages = [
-            {
-                "role": "system",
-                "content": """You are a helpful plant care assistant. You can answer questions about:
-                - Plant identification
-                - Plant care and maintenance
-                - Common plant problems and solutions
-                - Growing tips and advice
-                - Plant diseases and pests
-                
-                Be friendly, informative, and practical in your responses. If you're unsure about something, 
-                recommend consulting with a local plant expert or nursery."""
-            }
+        return [
+            _SYSTEM_CHAT_MSG,
+            *self._trim_history(conversation_history),
+            {"role": "user", "content": user_message}
         ]
+    
+    def _trim_history(self, conversation_history: Optional[list]) -> list:
+        """
+        Keep the newest history messages that fit CHAT_HISTORY_TOKEN_BUDGET.
         
-        # Add conversation history if provided
-        if conversation_history:
-            messages.extend(conversation_history)
+        Messages are reduced to role and content, since stored messages carry
+        extra fields (such as timestamps) the chat API doesn't accept.
+        """
+        if not conversation_history:
+            return []
+        
+        model = _MODELS['chat']['primary_model']
+        budget = CHAT_HISTORY_TOKEN_BUDGET
+        trimmed = []
         
-        # Add current user message
-        messages.append({"role": "user", "content": user_message})
+        for message in reversed(conversation_history):
+            content = message.get('content')
+            tokens = _count_tokens(content, model) + _MESSAGE_OVERHEAD_TOKENS
+            if tokens > budget:
+                break
+            budget -= tokens
+            trimmed.append({'role': message['role'], 'content': content})
         
-        return messages
+        trimmed.reverse()
+        return trimmed
     
-    def _update_conversation_history(self, history: list, user_message: str, ai_response: str) -> list:
+    def _update_conversation_history(self, history: deque, user_message: str, ai_response: str) -> deque:
         """Update conversation history with new messages."""
-        # Keep only last 10 messages to manage token usage
-        max_history = 10
-        
+        # The deque's maxlen drops the oldest messages to manage token usage
         history.append({"role": "user", "content": user_message})
         history.append({"role": "assistant", "content": ai_response})
         
-        # Trim history if too long
-        if len(history) > max_history:
-            history = history[-max_history:]
-        
         return history
+
+_client: Optional[OpenAIClient] = None
+
+def get_client() -> OpenAIClient:
+    """Return the process-wide OpenAIClient shared by all blueprints."""
+    global _client
+    
+    if _client is None:
+        _client = OpenAIClient()
+    
+    return _client
+
+async def close_client() -> None:
+    """Close the shared OpenAIClient (called on app shutdown)."""
+    global _client
+    
+    if _client is not None:
+        await _client.aclose()
+        _client = None
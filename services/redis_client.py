@@ -0,0 +1,31 @@
+import os
+from typing import Optional
+
+_redis = None
+
+def get_redis() -> Optional["redis.asyncio.Redis"]:
+    """
+    Return the shared async Redis connection pool.
+
+    Returns None when REDIS_URL is not configured, so callers can fall back
+    to process-local storage during development.
+    """
+    global _redis
+
+    redis_url = os.getenv('REDIS_URL')
+    if not redis_url:
+        return None
+
+    if _redis is None:
+        import redis.asyncio
+        _redis = redis.asyncio.Redis.from_url(redis_url, decode_responses=True)
+
+    return _redis
+
+async def close_redis() -> None:
+    """Close the shared Redis connection pool (called on app shutdown)."""
+    global _redis
+
+    if _redis is not None:
+        await _redis.aclose()
+        _redis = None
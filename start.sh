@@ -18,4 +18,4 @@ pip install -r requirements.txt
 
 # Start the application
 echo "🚀 Starting application..."
-python main.py
+exec gunicorn -c gunicorn_conf.py app:app